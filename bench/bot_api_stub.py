@@ -0,0 +1,236 @@
+""" Local stand-in for the Telegram Bot API, for running the bot under load without talking to Telegram
+
+The stub hands out the updates queued with add_update() through getUpdates, or pushes them to a
+webhook, and records every message the bot sends. Point the bot at it with
+SAS_API_BASE_URL=http://<host>:<port>/bot and SAS_API_BASE_FILE_URL=http://<host>:<port>/file/bot
+"""
+import email.parser
+import itertools
+import json
+import re
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+
+# Served for every file the bot downloads, e.g. the photos of new assassins
+PHOTO_FILE = BASE_DIR / 'qr-code.png'
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Stub', 'username': 'stub_bot'}
+
+_METHOD_PATH = re.compile(r'^/bot[^/]+/(\w+)$')
+
+
+class SentMessage:
+    """ Something the bot sent to a chat, with the time it reached the stub """
+
+    def __init__(self, method, chat_id, text, sent_at):
+        self.method = method
+        self.chat_id = chat_id
+        self.text = text
+        self.sent_at = sent_at
+
+
+class _ApiRequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'  # Keeps the connections of the bot's pool open
+
+    def do_GET(self):
+        if self.path.startswith('/file/'):
+            data = PHOTO_FILE.read_bytes()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        else:
+            self._reply(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+
+    def do_POST(self):
+        match = _METHOD_PATH.match(self.path)
+        if not match:
+            self._reply(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+            return
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        params = _parse_params(self.headers.get('Content-Type', ''), body)
+        result = self.server.stub.call(match.group(1), params)
+        if result is None:
+            self._reply(400, {'ok': False, 'error_code': 400, 'description': 'Bad Request: method not supported'})
+        else:
+            self._reply(200, {'ok': True, 'result': result})
+
+    def _reply(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _parse_params(content_type, body):
+    """ Parses a JSON or multipart/form-data request, uploaded files are replaced by their size """
+    if content_type.startswith('multipart/form-data'):
+        message = email.parser.BytesParser().parsebytes(
+            b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body)
+        params = {}
+        for part in message.get_payload():
+            payload = part.get_payload(decode=True)
+            if part.get_filename():
+                params[part.get_param('name', header='content-disposition')] = len(payload)
+            else:
+                params[part.get_param('name', header='content-disposition')] = payload.decode()
+        return params
+    if body:
+        return json.loads(body)
+    return {}
+
+
+class _Server(ThreadingHTTPServer):
+    request_queue_size = 1024  # The bot opens many connections at once under load
+    daemon_threads = True
+
+
+class BotApiStub:
+    """ Serves the subset of the Bot API the bot uses and keeps what was sent, per chat
+
+    Updates are delivered in the order they were added, either through long polling or, if a
+    webhook URL is given, by posting them to the bot one after another.
+    """
+
+    def __init__(self, listen='127.0.0.1', port=0, webhook_url=None, webhook_secret=None):
+        self.lock = threading.Condition()
+        self.updates = []
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.sent = {}  # Chat id -> list of SentMessage
+        self.calls = {}  # Bot API method -> number of calls
+        self.webhook_url = webhook_url
+        self.webhook_secret = webhook_secret
+        self.pushed = 0
+        self.httpd = _Server((listen, port), _ApiRequestHandler)
+        self.httpd.stub = self
+        self.threads = []
+        self.running = False
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.httpd.server_address)
+
+    def start(self):
+        self.running = True
+        self.threads.append(threading.Thread(target=self.httpd.serve_forever, name='api-stub', daemon=True))
+        if self.webhook_url:
+            self.threads.append(threading.Thread(target=self._push_updates, name='api-stub-push', daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+            self.lock.notify_all()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def add_update(self, update):
+        """ Queues an update for the bot, the update_id is assigned here
+
+        :return: the time the update was queued
+        """
+        with self.lock:
+            update['update_id'] = next(self.update_ids)
+            self.updates.append(update)
+            self.lock.notify_all()
+            return time.perf_counter()
+
+    def sent_count(self, chat_id):
+        with self.lock:
+            return len(self.sent.get(chat_id, ()))
+
+    def wait_for(self, chat_id, start, pattern, timeout):
+        """ Waits until the bot sent something matching the pattern to a chat
+
+        :param start: number of messages in the chat to skip, as returned by sent_count before the update was queued
+        :return: the matching SentMessage, None after the timeout
+        """
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while True:
+                for sent in self.sent.get(chat_id, [])[start:]:
+                    if re.search(pattern, sent.text or ''):
+                        return sent
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.lock.wait(remaining)
+
+    def call(self, method, params):
+        """ Executes a Bot API method, returns its result or None if it is not supported """
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        if method == 'getUpdates':
+            return self._get_updates(int(params.get('offset') or 0), int(params.get('limit') or 100),
+                                     float(params.get('timeout') or 0))
+        if method == 'getMe':
+            return BOT_USER
+        if method in ('deleteWebhook', 'setWebhook', 'answerCallbackQuery'):
+            return True
+        if method == 'getFile':
+            return {'file_id': params['file_id'], 'file_unique_id': params['file_id'], 'file_size': 1024,
+                    'file_path': 'photos/{}.jpg'.format(params['file_id'])}
+        if method in ('sendMessage', 'sendPhoto', 'editMessageText'):
+            return self._record(method, params)
+        return None
+
+    def _record(self, method, params):
+        chat_id = int(params['chat_id'])
+        message = {'message_id': next(self.message_ids), 'date': int(time.time()), 'from': BOT_USER,
+                   'chat': {'id': chat_id, 'type': 'private'}}
+        if method == 'sendPhoto':
+            text = params.get('caption')
+            message['caption'] = text
+            file_id = params['photo'] if isinstance(params['photo'], str) else 'uploaded-{}'.format(
+                message['message_id'])
+            message['photo'] = [{'file_id': file_id, 'file_unique_id': file_id, 'width': 800, 'height': 800}]
+        else:
+            text = params.get('text')
+            message['text'] = text
+        with self.lock:
+            self.sent.setdefault(chat_id, []).append(SentMessage(method, chat_id, text, time.perf_counter()))
+            self.lock.notify_all()
+        return message
+
+    def _get_updates(self, offset, limit, timeout):
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            if offset:  # Telegram forgets every update before the offset once it has been confirmed
+                self.updates = [update for update in self.updates if update['update_id'] >= offset]
+            while not self.updates and self.running and time.monotonic() < deadline:
+                self.lock.wait(deadline - time.monotonic())
+            return self.updates[:limit]
+
+    def _push_updates(self):
+        while True:
+            with self.lock:
+                while not self.updates and self.running:
+                    self.lock.wait()
+                if not self.running:
+                    return
+                update = self.updates.pop(0)
+            request = urllib.request.Request(self.webhook_url, data=json.dumps(update).encode(),
+                                             headers={'Content-Type': 'application/json'})
+            if self.webhook_secret:
+                request.add_header('X-Telegram-Bot-Api-Secret-Token', self.webhook_secret)
+            for attempt in range(50):  # The bot might still be starting up
+                try:
+                    urllib.request.urlopen(request, timeout=10).read()
+                    self.pushed += 1
+                    break
+                except OSError:
+                    time.sleep(0.1)
@@ -0,0 +1,190 @@
+""" Microbenchmarks for bot_database_interface at realistic database sizes
+
+Seeds a throwaway database per scale with games in progress, each with a complete target ring, and
+times the public functions on random players and games. The JSON report has a stable layout with
+sorted keys, so reports of two versions can be diffed or compared by a script.
+
+    python -m bench.db_bench --scales 10 1000 10000 100000 --output before.json
+    SAS_DB_MODE=wal python -m bench.db_bench --no-entity-cache
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+from src import bot_database_interface as db
+from src.game_engine import GameRing
+
+REPORT_VERSION = 1
+
+MASTER_IDS = 10000000  # Chat ids of the game masters start here, players are numbered from 1
+
+
+def seed(db_file, assassins, players_per_game, rng):
+    """ Creates a migrated database with started games, every player alive and in the ring of their game
+
+    :return: a dict of game id -> list of player ids in ring order
+    """
+    db.set_database(db_file)
+    db.migrate()
+    con = sqlite3.connect(db_file)
+    games = {}
+    for player_id in range(1, assassins + 1):
+        games.setdefault(100 + (player_id - 1) // players_per_game, []).append(player_id)
+    con.executemany("INSERT INTO Games(id, game_master_id, game_master_user, started) VALUES (?, ?, ?, 1)",
+                    [(game_id, MASTER_IDS + game_id, 'master{}'.format(game_id)) for game_id in games])
+    rows = []
+    for game_id, ring in games.items():
+        rng.shuffle(ring)
+        for i, player_id in enumerate(ring):
+            rows.append((player_id, 'Assassin {}'.format(player_id), 'Agent{}'.format(player_id),
+                         'Street {}'.format(player_id), 'Assassination', player_id % 2, rng.randrange(4),
+                         1 if rng.random() < 0.1 else 0, game_id, ring[(i + 1) % len(ring)], ring[i - 1]))
+    con.executemany("INSERT INTO Assassins(id, name, code_name, address, major, needs_weapon, tally, subscribed, "
+                    "game, target, hunter) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    con.commit()
+    con.execute("ANALYZE")
+    con.close()
+    return games
+
+
+def measure(func, make_args, seconds, max_calls):
+    """ Calls func with fresh arguments until the time budget or max_calls is used up
+
+    :param make_args: returns the (args, kwargs) of the next call, it is not part of the measured time
+    """
+    timings = []
+    deadline = time.perf_counter() + seconds
+    while len(timings) < max_calls and (len(timings) < 5 or time.perf_counter() < deadline):
+        args, kwargs = make_args()
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return {
+        'calls': len(timings),
+        'mean_us': round(statistics.fmean(timings) * 1e6, 1),
+        'p50_us': round(timings[len(timings) // 2] * 1e6, 1),
+        'p95_us': round(timings[int(len(timings) * 0.95)] * 1e6, 1),
+        'max_us': round(timings[-1] * 1e6, 1),
+    }
+
+
+def run_scale(work_dir, assassins, args, rng):
+    games = seed(os.path.join(work_dir, 'bench-{}.sqlite3'.format(assassins)), assassins,
+                 min(args.players_per_game, assassins), rng)
+    db.start_storage()
+    game_ids = list(games)
+    player_ids = [player_id for ring in games.values() for player_id in ring]
+
+    def game():
+        return (rng.choice(game_ids),), {}
+
+    def player():
+        return (rng.choice(player_ids),), {}
+
+    def new_task():
+        game_id = rng.choice(game_ids)
+        db.add_task(game_id, 'Find the secret', '^secret$', sync=True)
+        return (game_id,), {}
+
+    alive = {game_id: list(ring) for game_id, ring in games.items()}
+
+    def victim(count=1):
+        game_id = rng.choice([game_id for game_id, ring in alive.items() if len(ring) > count + 1])
+        dead = [alive[game_id].pop(rng.randrange(len(alive[game_id]))) for _ in range(count)]
+        return game_id, dead
+
+    def ring_leaderboard(game_id):
+        return GameRing(game_id, db.get_ring_state(game_id)).leaderboard_rows()
+
+    # Reads first, the kills at the end change the rings
+    benchmarks = [
+        ('get_assassin', db.get_assassin, player),
+        ('get_session', db.get_session, player),
+        ('game_started', db.game_started, game),
+        ('get_master', db.get_master, game),
+        ('get_hunter', db.get_hunter, player),
+        ('get_target_of', db.get_target_of, player),
+        ('get_assassin_ids', db.get_assassin_ids, game),
+        ('get_assassin_ids(only_alive)', db.get_assassin_ids,
+         lambda: ((rng.choice(game_ids),), {'only_alive': True})),
+        ('get_subscribers', db.get_subscribers, game),
+        ('get_dossiers', db.get_dossiers, game),
+        ('leaderboard: get_leaderboard_rows', db.get_leaderboard_rows, game),
+        ('leaderboard: GameRing', ring_leaderboard, game),
+        ('give_task_point', db.give_task_point, player),
+        ('set_task_inactive', db.set_task_inactive, new_task),
+        ('assign_targets', db.assign_targets, game),
+        ('kill_player', db.kill_player, lambda: ((victim()[1][0],), {'assassinated': True})),
+        ('kill_players(5)', db.kill_players, lambda: (victim(5), {})),
+    ]
+    results = {}
+    for name, func, make_args in benchmarks:
+        if args.only and not any(pattern in name for pattern in args.only):
+            continue
+        max_calls = args.max_calls
+        if name == 'kill_player':  # Kills are for good, leave half of the victims to kill_players
+            max_calls = min(max_calls, sum(len(ring) - 2 for ring in alive.values()) // 2)
+        elif name == 'kill_players(5)':  # Every game keeps two players alive
+            max_calls = min(max_calls, sum((len(ring) - 2) // 5 for ring in alive.values()))
+        if max_calls < 1:
+            continue
+        results[name] = measure(func, make_args, args.seconds, max_calls)
+    db.close_connections()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scales', type=int, nargs='+', default=[10, 1000, 10000, 100000],
+                        help='numbers of assassins to seed')
+    parser.add_argument('--players-per-game', type=int, default=50)
+    parser.add_argument('--seconds', type=float, default=0.5, help='time budget per function and scale')
+    parser.add_argument('--max-calls', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--no-entity-cache', action='store_true', help='time every read against SQLite')
+    parser.add_argument('--only', nargs='+', help='only run the functions whose name contains one of these')
+    parser.add_argument('--output', help='write the report to this file instead of stdout')
+    args = parser.parse_args()
+
+    if args.no_entity_cache:
+        db.ENTITY_CACHE_SIZE = 0
+    rng = random.Random(args.seed)
+    report = {
+        'report_version': REPORT_VERSION,
+        'config': {
+            'entity_cache': db.ENTITY_CACHE_SIZE > 0,
+            'max_calls': args.max_calls,
+            'players_per_game': args.players_per_game,
+            'seconds': args.seconds,
+            'seed': args.seed,
+            'storage_mode': db.STORAGE_MODE,
+        },
+        'environment': {
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+        },
+        'results': {},
+    }
+    with tempfile.TemporaryDirectory(prefix='sas-bench-') as work_dir:
+        for assassins in args.scales:
+            print('Benchmarking {} assassins'.format(assassins), file=sys.stderr)
+            report['results'][str(assassins)] = run_scale(work_dir, assassins, args, rng)
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
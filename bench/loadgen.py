@@ -0,0 +1,247 @@
+""" Synthetic load for the bot, run against the real dispatcher and a local stand-in for the Bot API
+
+Starts BotApiStub, runs telegrambot.main() in a subprocess on a throwaway database and simulates
+game masters and players: the /joinGame conversation, starting the games, leaderboard spam, a task
+with answers and rounds of /confirmKill -> /confirmDead. Every step waits for the bot's reply, the
+report lists the latency percentiles per command and the overall throughput.
+
+    python -m bench.loadgen --games 10 --players 100
+"""
+import argparse
+import json
+import os
+import random
+import re
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bench.bot_api_stub import BotApiStub, BASE_DIR
+
+TOKEN = '123456:stub'
+
+MASTER_IDS = 1000000  # Chat ids of the simulated game masters start here, players start at PLAYER_IDS
+PLAYER_IDS = 2000000
+
+# Seconds a step waits for the reply of the bot before it is counted as failed
+REPLY_TIMEOUT = 60
+
+# Seconds a user takes to answer in a conversation. The ConversationHandler drops updates that arrive before
+# the handler of the previous step has returned, which real users are too slow to run into
+THINK_TIME = 0.1
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))]
+
+
+class LoadGenerator:
+    """ Plays the users, one closed loop per simulated user, many of them at the same time """
+
+    def __init__(self, stub, concurrency, think_time=THINK_TIME):
+        self.stub = stub
+        self.think_time = think_time
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.timings = {}  # Command -> list of seconds
+        self.failures = {}  # Command -> number of replies that did not arrive in time or reported an error
+        self.lock = threading.Lock()
+        self.message_ids = iter(range(1, 1 << 62))
+
+    def step(self, chat_id, command, pattern, text=None, photo=False, callback_data=None, answer=False,
+             failure=None):
+        """ Sends one update from a user and waits for the reply matching the pattern
+
+        :param command: name the latency is reported under
+        :param answer: the update answers the previous step of a conversation, the user thinks before sending it
+        :param failure: pattern of the replies that are counted as failed instead of timed, e.g. an error message
+        :return: the text of the reply, None if it did not arrive in time
+        """
+        if answer:
+            time.sleep(self.think_time)
+        user = {'id': chat_id, 'is_bot': False, 'first_name': 'User {}'.format(chat_id),
+                'username': 'user{}'.format(chat_id)}
+        message = {'message_id': next(self.message_ids), 'date': int(time.time()), 'from': user,
+                   'chat': {'id': chat_id, 'type': 'private'}}
+        if callback_data is not None:  # Pressed a button below a message of the bot
+            bot_message = {'message_id': message['message_id'], 'date': message['date'], 'chat': message['chat'],
+                           'text': 'Do you need a weapon?'}
+            update = {'callback_query': {'id': str(message['message_id']), 'from': user, 'chat_instance': '1',
+                                         'data': callback_data, 'message': bot_message}}
+        elif photo:
+            update = {'message': dict(message, photo=[
+                {'file_id': 'small-{}'.format(chat_id), 'file_unique_id': 's{}'.format(chat_id), 'width': 320,
+                 'height': 320},
+                {'file_id': 'large-{}'.format(chat_id), 'file_unique_id': 'l{}'.format(chat_id), 'width': 1280,
+                 'height': 1280}])}
+        else:
+            update = {'message': dict(message, text=text)}
+            if text.startswith('/'):
+                update['message']['entities'] = [{'type': 'bot_command', 'offset': 0,
+                                                  'length': len(text.split(' ')[0])}]
+        start = self.stub.sent_count(chat_id)
+        queued_at = self.stub.add_update(update)
+        reply = self.stub.wait_for(chat_id, start, pattern, REPLY_TIMEOUT)
+        with self.lock:
+            if reply is None or (failure and re.search(failure, reply.text or '')):
+                self.failures[command] = self.failures.get(command, 0) + 1
+            else:
+                self.timings.setdefault(command, []).append(reply.sent_at - queued_at)
+        return reply.text if reply else None
+
+    def run_all(self, func, items):
+        """ Runs func for every item on the simulated users' threads and waits for all of them """
+        return list(self.executor.map(func, items))
+
+    def new_game(self, master_id):
+        for attempt in range(20):  # Game ids are random and may collide
+            reply = self.step(master_id, '/newgame', r'admin of game|already have a game', text='/newgame')
+            match = re.search(r'admin of game (\d+)', reply or '')
+            if match:
+                return int(match.group(1))
+        raise RuntimeError('Could not create a game for {}'.format(master_id))
+
+    def join_game(self, player):
+        chat_id, game_id = player
+        self.step(chat_id, '/joinGame', r'3-digit code', text='/joinGame')
+        self.step(chat_id, 'join: game code', r'full name', text=str(game_id), answer=True)
+        self.step(chat_id, 'join: name', r'codename', text='Player {}'.format(chat_id), answer=True)
+        self.step(chat_id, 'join: code name', r'weapon', text='Agent {}'.format(chat_id), answer=True)
+        self.step(chat_id, 'join: weapon', r'address', callback_data=random.choice(('0', '1')), answer=True)
+        self.step(chat_id, 'join: address', r'what you study', text='Street {}'.format(chat_id), answer=True)
+        self.step(chat_id, 'join: major', r'pretty picture', text='Computer Science', answer=True)
+        self.step(chat_id, 'join: photo', r'That\'s it', photo=True, answer=True)
+
+    def answer_task(self, chat_id):
+        if 'Enter the solution' in (self.step(chat_id, '/task', r'Enter the solution|no current task|not enrolled',
+                                              text='/task') or ''):
+            self.step(chat_id, 'task: answer', r'correct|could not be checked|already been stopped',
+                      text=random.choice(('secret', 'wrong')), answer=True, failure=r'could not be checked')
+
+    def kill(self, pair):
+        hunter_id, target_id = pair
+        self.step(hunter_id, '/confirmKill', r'check with your target|already issued|not enrolled',
+                  text='/confirmKill')
+        self.step(target_id, '/confirmDead', r'too weak|Nobody has claimed|not enrolled', text='/confirmDead')
+
+    def report(self, elapsed):
+        commands = {}
+        steps = 0
+        for command, timings in sorted(self.timings.items()):
+            timings.sort()
+            steps += len(timings)
+            commands[command] = {
+                'count': len(timings),
+                'failed': self.failures.get(command, 0),
+                'p50_ms': round(percentile(timings, 0.5) * 1000, 2),
+                'p95_ms': round(percentile(timings, 0.95) * 1000, 2),
+                'p99_ms': round(percentile(timings, 0.99) * 1000, 2),
+                'max_ms': round(timings[-1] * 1000, 2),
+            }
+        for command, failed in self.failures.items():
+            commands.setdefault(command, {'count': 0, 'failed': failed})
+        return {'elapsed_seconds': round(elapsed, 2), 'steps': steps,
+                'steps_per_second': round(steps / elapsed, 1) if elapsed else None,
+                'api_calls': dict(self.stub.calls), 'commands': commands}
+
+
+def ring_pairs(db_file, game_id):
+    """ Returns disjoint (hunter, target) pairs of a game, so each kill can be confirmed independently """
+    con = sqlite3.connect(db_file)
+    try:
+        targets = dict(con.execute("SELECT id, target FROM Assassins WHERE game=? AND target IS NOT NULL",
+                                   (game_id,)).fetchall())
+    finally:
+        con.close()
+    pairs, used = [], set()
+    for hunter_id, target_id in targets.items():
+        if hunter_id != target_id and hunter_id not in used and target_id not in used:
+            pairs.append((hunter_id, target_id))
+            used.update((hunter_id, target_id))
+    return pairs
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_bot(stub, work_dir, webhook_port=None, extra_env=None):
+    """ Runs telegrambot.main() in a subprocess that talks to the stub and uses a database in work_dir """
+    os.makedirs(os.path.join(work_dir, 'images'), exist_ok=True)
+    env = dict(os.environ, SAS_TOKEN=TOKEN, SAS_API_BASE_URL=stub.url + '/bot',
+               SAS_API_BASE_FILE_URL=stub.url + '/file/bot', SAS_DB_FILE=os.path.join(work_dir, 'db.sqlite3'),
+               PYTHONPATH=str(BASE_DIR))
+    if webhook_port:
+        env.update(SAS_UPDATE_MODE='webhook', SAS_WEBHOOK_PORT=str(webhook_port))
+    env.update(extra_env or {})
+    return subprocess.Popen([sys.executable, '-m', 'src.telegrambot'], cwd=work_dir, env=env)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--games', type=int, default=10)
+    parser.add_argument('--players', type=int, default=100, help='players per game')
+    parser.add_argument('--concurrency', type=int, default=64, help='users acting at the same time')
+    parser.add_argument('--leaderboard', type=int, default=2, help='leaderboard requests per player')
+    parser.add_argument('--kill-rounds', type=int, default=3)
+    parser.add_argument('--think-time', type=float, default=THINK_TIME, help='seconds between conversation steps')
+    parser.add_argument('--webhook', action='store_true', help='push updates to a webhook instead of polling')
+    parser.add_argument('--output', help='write the report as JSON to this file')
+    args = parser.parse_args()
+
+    webhook_port = free_port() if args.webhook else None
+    stub = BotApiStub(webhook_url='http://127.0.0.1:{}/telegram'.format(webhook_port) if webhook_port else None)
+    stub.start()
+    work_dir = tempfile.mkdtemp(prefix='sas-load-')
+    bot = start_bot(stub, work_dir, webhook_port)
+    generator = LoadGenerator(stub, args.concurrency, args.think_time)
+    start = time.perf_counter()
+    try:
+        masters = [MASTER_IDS + game for game in range(args.games)]
+        games = dict(zip(masters, generator.run_all(generator.new_game, masters)))
+        players = [(PLAYER_IDS + game * args.players + number, game_id)
+                   for game, game_id in enumerate(games.values()) for number in range(args.players)]
+        generator.run_all(generator.join_game, players)
+        generator.run_all(lambda master_id: generator.step(master_id, '/startgame', r'has been started',
+                                                          text='/startgame'), masters)
+        player_ids = [chat_id for chat_id, game_id in players]
+        generator.run_all(lambda chat_id: generator.step(chat_id, '/leaderboard', r'kills',
+                                                        text='/leaderboard'),
+                          player_ids * args.leaderboard)
+
+        def create_task(master_id):
+            generator.step(master_id, '/task', r'Specify the task', text='/task')
+            generator.step(master_id, 'task: message', r'solution Regex', text='Find the secret', answer=True)
+            generator.step(master_id, 'task: solution', r'being forwarded', text='^secret$', answer=True)
+        generator.run_all(create_task, masters)
+        generator.run_all(generator.answer_task, player_ids)
+
+        db_file = os.path.join(work_dir, 'db.sqlite3')
+        for round in range(args.kill_rounds):
+            pairs = [pair for game_id in games.values() for pair in ring_pairs(db_file, game_id)]
+            generator.run_all(generator.kill, pairs)
+        result = generator.report(time.perf_counter() - start)
+    finally:
+        bot.terminate()  # The bot finishes sending what it has queued before it exits
+        try:
+            bot.wait(120)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+        stub.stop()
+    output = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output)
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+""" Replays updates recorded in production through the dispatcher, against a throwaway database
+
+Record with SAS_RECORD_FILE=updates.jsonl (see src/recorder.py), then replay the file at its original
+pace or faster. The bot runs in this process and talks to a local stand-in for the Bot API, the
+report lists the latency percentiles per handler, from the update reaching the dispatcher until its
+callback returned. An update is only sent once the callbacks of the previous update of its chat have
+returned, the conversations of the bot drop updates that arrive while their last step still runs.
+Updates that depend on another chat, e.g. answers to a task the master has just set, can still
+arrive too early when replaying much faster than recorded, the report counts them as unhandled.
+
+    python -m bench.replay updates.jsonl --speed 10 --output replay.json
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import warnings
+
+from bench.bot_api_stub import BotApiStub, BASE_DIR
+from bench.loadgen import TOKEN, percentile
+
+
+def read_recording(path):
+    """ Returns the recorded (arrival time, update, master of the game named by the text) in order """
+    updates = []
+    with open(path, encoding='utf-8') as recording:
+        for line in recording:
+            entry = json.loads(line)
+            if 'u' in entry:  # Skips the header written whenever the bot was started
+                updates.append((entry['t'], entry['u'], entry.get('g')))
+    return updates
+
+
+class ReplayTimer:
+    """ Times the callbacks the dispatcher runs for the replayed updates """
+
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.queued_at = {}  # Update id -> time it was put on the update queue
+        self.timings = {}  # Callback name -> list of seconds
+        self.pending = 0  # Callbacks started and not returned yet
+        self.processed = 0  # Updates the dispatcher went through
+        self.handled = set()  # Ids of the updates at least one callback was run for
+        self.promises = {}  # Chat id -> promises of the callbacks run for its last update
+
+    def instrument(self, dispatcher):
+        """ Wraps the run_async of the dispatcher, every handler of the bot is run through it """
+        run_async = dispatcher.run_async
+
+        def timed_run_async(func, *args, update=None, **kwargs):
+            queued_at = self.queued_at.get(getattr(update, 'update_id', None), time.perf_counter())
+            with self.lock:
+                self.pending += 1
+                self.handled.add(getattr(update, 'update_id', None))
+
+            def timed(*args, **kwargs):
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    elapsed = time.perf_counter() - queued_at
+                    with self.lock:
+                        self.timings.setdefault(func.__name__, []).append(elapsed)
+                        self.pending -= 1
+                        self.lock.notify_all()
+            promise = run_async(timed, *args, update=update, **kwargs)
+            chat = getattr(update, 'effective_chat', None)
+            if chat is not None:
+                with self.lock:
+                    self.promises.setdefault(chat.id, []).append(promise)
+            return promise
+        with warnings.catch_warnings():  # PTB discourages custom attributes, this one only lives for the replay
+            warnings.simplefilter('ignore')
+            dispatcher.run_async = timed_run_async
+
+    def queued(self, update):
+        self.queued_at[update.update_id] = time.perf_counter()
+
+    def done(self, update, context):
+        """ Callback for a TypeHandler in the last group, runs after the other groups dispatched the update """
+        with self.lock:
+            self.processed += 1
+            self.lock.notify_all()
+
+    def wait_for_chat(self, chat_id, updates, timeout):
+        """ Waits until the first updates went through the dispatcher and the callbacks of the chat returned
+
+        The conversation handlers only see the new state of a chat once the promise of its callback is done,
+        which is a little after the callback returned.
+        """
+        if not self.wait(updates, timeout, callbacks=False):
+            return False
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            promises = self.promises.pop(chat_id, [])
+        return all(promise.done.wait(max(0.0, deadline - time.monotonic())) for promise in promises)
+
+    def wait(self, updates, timeout, callbacks=True):
+        """ Waits until the first updates went through the dispatcher and, unless callbacks is False, every
+        callback returned
+        """
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while self.processed < updates or (callbacks and self.pending):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.lock.wait(remaining)
+        return True
+
+    def report(self):
+        handlers = {}
+        for name, timings in sorted(self.timings.items()):
+            timings.sort()
+            handlers[name] = {
+                'count': len(timings),
+                'p50_ms': round(percentile(timings, 0.5) * 1000, 2),
+                'p95_ms': round(percentile(timings, 0.95) * 1000, 2),
+                'p99_ms': round(percentile(timings, 0.99) * 1000, 2),
+                'max_ms': round(timings[-1] * 1000, 2),
+            }
+        return handlers
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('recording', help='file written by the recorder of the bot')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='factor to speed up the original pace by, 0 sends the updates as fast as possible')
+    parser.add_argument('--max-gap', type=float, default=60.0,
+                        help='longer pauses between updates are cut to this many seconds, e.g. nights or restarts')
+    parser.add_argument('--timeout', type=float, default=300.0, help='seconds to wait for the last callbacks')
+    parser.add_argument('--output', help='write the report as JSON to this file')
+    args = parser.parse_args()
+
+    recording = read_recording(os.path.abspath(args.recording))
+    output = os.path.abspath(args.output) if args.output else None
+    stub = BotApiStub()
+    stub.start()
+    work_dir = tempfile.mkdtemp(prefix='sas-replay-')
+    os.makedirs(os.path.join(work_dir, 'images'))
+    os.chdir(work_dir)  # The bot keeps its images and its log in the working directory
+    sys.path.insert(0, str(BASE_DIR))  # For the worker processes of the bot, now that the directory changed
+    os.environ.update(SAS_TOKEN=TOKEN, SAS_API_BASE_URL=stub.url + '/bot',
+                      SAS_API_BASE_FILE_URL=stub.url + '/file/bot', SAS_DB_FILE=os.path.join(work_dir, 'db.sqlite3'))
+    os.environ.pop('SAS_RECORD_FILE', None)
+
+    from telegram import Update
+    from telegram.ext import TypeHandler
+    from src import telegrambot
+    from src.bot_database_interface import get_session
+
+    telegrambot.migrate()
+    telegrambot.start_storage()
+    telegrambot.answer_checker.start()
+    updater = telegrambot.build_updater()
+    dispatcher = updater.dispatcher
+    timer = ReplayTimer()
+    timer.instrument(dispatcher)
+    dispatcher.add_handler(TypeHandler(Update, timer.done), group=1000)
+    ready = threading.Event()
+    dispatcher_thread = threading.Thread(target=dispatcher.start, name='dispatcher', kwargs={'ready': ready})
+    dispatcher_thread.start()
+    ready.wait()
+
+    start = time.perf_counter()
+    offset = 0.0  # Seconds of the recording that were skipped as gaps
+    previous = recording[0][0] if recording else 0.0
+    last_update = {}  # Chat id -> number of its last update sent
+    completed = True
+    try:
+        for update_id, (arrived, data, master_id) in enumerate(recording, 1):
+            offset += max(0.0, arrived - previous - args.max_gap)
+            previous = arrived
+            if args.speed:
+                delay = start + (arrived - recording[0][0] - offset) / args.speed - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            data['update_id'] = update_id
+            if master_id is not None:  # The game code of the master in this replay
+                game_id = get_session(master_id)['game_id']
+                if game_id is not None:
+                    data['message']['text'] = str(game_id)
+            update = Update.de_json(data, updater.bot)
+            chat_id = update.effective_chat.id if update.effective_chat else None
+            if chat_id is not None and chat_id in last_update:
+                completed = timer.wait_for_chat(chat_id, last_update[chat_id], args.timeout) and completed
+            last_update[chat_id] = update_id
+            timer.queued(update)
+            dispatcher.update_queue.put(update)
+        completed = timer.wait(len(recording), args.timeout) and completed
+        elapsed = time.perf_counter() - start
+    finally:
+        dispatcher.stop()
+        dispatcher_thread.join()
+        telegrambot.broadcaster.shutdown()
+        telegrambot.photo_ingester.shutdown()
+        telegrambot.answer_checker.shutdown()
+        telegrambot.close_connections()
+        stub.stop()
+
+    result = {
+        'api_calls': dict(stub.calls),
+        'completed': completed,
+        'elapsed_seconds': round(elapsed, 2),
+        'handled': len(timer.handled),
+        'unhandled': len(recording) - len(timer.handled),  # No callback ran, e.g. texts outside of a conversation
+        'handlers': timer.report(),
+        'recorded_seconds': round(recording[-1][0] - recording[0][0], 2) if recording else 0,
+        'speed': args.speed,
+        'updates': len(recording),
+    }
+    report = json.dumps(result, indent=2, sort_keys=True)
+    if output:
+        with open(output, 'w') as output_file:
+            output_file.write(report)
+    print(report)
+
+
+if __name__ == '__main__':
+    main()
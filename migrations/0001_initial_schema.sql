@@ -0,0 +1,52 @@
+-- Tables as they exist in production, created only if missing so existing databases are left untouched
+
+create table if not exists Admins
+(
+    id INTEGER
+        primary key
+        unique
+);
+
+create table if not exists Games
+(
+    id               INTEGER
+        primary key
+        unique,
+    game_master_id   INTEGER
+        unique,
+    game_master_user VARCHAR(45)
+        unique,
+    started          INTEGER default 0 not null,
+    free_for_all     INTEGER default 0 not null
+);
+
+create table if not exists Assassins
+(
+    id            INTEGER     not null
+        primary key
+        unique,
+    name          VARCHAR(45) not null,
+    code_name     VARCHAR(45) not null,
+    address       VARCHAR(45) not null,
+    major         VARCHAR(45) not null,
+    needs_weapon  INTEGER     not null,
+    presumed_dead INTEGER default 0 not null,
+    target        INTEGER default NULL,
+    tally         INTEGER default 0 not null,
+    task_answered INTEGER default 0 not null,
+    jokers_used   INTEGER default 0 not null,
+    subscribed    INTEGER default 0 not null,
+    game          INTEGER     not null
+        references Games
+);
+
+create table if not exists Task
+(
+    id       INTEGER not null
+        primary key,
+    message  TEXT    not null,
+    solution TEXT    not null,
+    active   INTEGER default 1 not null,
+    game     INTEGER not null
+        references Games
+);
@@ -0,0 +1,13 @@
+-- Games.game_master_id is already covered by the index behind its unique constraint
+
+-- get_hunter and the ring update in kill_player look players up by the target pointing at them, until 0004
+create index if not exists Assassins_target on Assassins (target);
+
+-- Covers get_assassin_ids (with and without only_alive) and last_man_standing, the id is the rowid
+create index if not exists Assassins_game_target on Assassins (game, target);
+
+-- get_subscribers only ever asks for the few subscribed players of a game
+create index if not exists Assassins_game_subscribed on Assassins (game) where subscribed = 1;
+
+-- get_active_task and set_task_inactive only ever touch the single active task of a game
+create index if not exists Task_game_active on Task (game) where active = 1;
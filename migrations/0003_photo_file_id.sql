@@ -0,0 +1,2 @@
+-- Telegram file_id of the photo of each assassin, so dossiers can be sent without uploading the file again
+alter table Assassins add column photo_file_id VARCHAR(100) default NULL;
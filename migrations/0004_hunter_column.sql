@@ -0,0 +1,9 @@
+-- Turns the target chain into a doubly-linked ring, so the hunter of a player is a primary key lookup as well
+alter table Assassins add column hunter INTEGER default NULL;
+
+update Assassins
+set hunter=(select Hunter.id from Assassins as Hunter where Hunter.target = Assassins.id)
+where target is not null;
+
+-- get_hunter and kill_player follow the hunter column now, nothing looks players up by their target any more
+drop index if exists Assassins_target;
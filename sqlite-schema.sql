@@ -1,3 +1,7 @@
+-- Test data in the shape of an unmigrated database, the bot upgrades it with migrations/ on its next start
+PRAGMA user_version=0;
+
+DROP TABLE IF EXISTS Task;
 DROP TABLE IF EXISTS Assassins;
 DROP TABLE IF EXISTS Admins;
 DROP TABLE IF EXISTS Games;
@@ -37,10 +41,22 @@ create table Assassins
     tally         INTEGER default 0 not null,
     task_answered INTEGER default 0 not null,
     jokers_used   INTEGER default 0 not null,
+    subscribed    INTEGER default 0 not null,
     game          INTEGER     not null
         references Games
 );
 
+create table Task
+(
+    id       INTEGER not null
+        primary key,
+    message  TEXT    not null,
+    solution TEXT    not null,
+    active   INTEGER default 1 not null,
+    game     INTEGER not null
+        references Games
+);
+
 insert into Assassins (id, name, code_name, address, major, needs_weapon, game)
 values (1, 'Bssassin', 'Bss', 'Bss Str. 1', 'Bdvanced assassination', 0, 111);
 
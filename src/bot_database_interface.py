@@ -1,11 +1,389 @@
+import functools
+import logging
+import queue
+import random
 import sqlite3
 import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
 from pathlib import Path
 
+from src.metrics import db_call_seconds, db_call_errors
+from src.tracing import record_span
+
 BASE_DIR = Path(__file__).resolve().parent.parent
-DB_FILE = os.path.join(BASE_DIR, 'db.sqlite3')
+DB_FILE = os.getenv('SAS_DB_FILE', os.path.join(BASE_DIR, 'db.sqlite3'))
+MIGRATIONS_DIR = os.path.join(BASE_DIR, 'migrations')
+
+# 'rollback' keeps SQLite's default journal, 'wal' enables WAL so reads keep running in parallel to the writes.
+# In both modes every write goes through a single writer thread once start_storage() has been called
+STORAGE_MODE = os.getenv('SAS_DB_MODE', 'rollback')
+
+# Seconds a connection waits on a locked database before giving up with 'database is locked'
+BUSY_TIMEOUT = 10
+
+# Maximum number of queued write operations the writer thread commits in one transaction
+WRITER_MAX_BATCH = 64
+
+# Seconds after the first operation of a batch the writer thread commits it, unless a caller waits for the commit
+WRITER_LINGER = 0.005
+
+# Size of the per-connection prepared statement cache, large enough to hold every query in this module
+STATEMENT_CACHE_SIZE = 256
+
+# Number of read results kept in the entity cache, 0 disables it. Every process has its own cache, so it has to
+# be disabled when several processes share the database. Admins are only read once, changing them needs a restart
+ENTITY_CACHE_SIZE = int(os.getenv('SAS_ENTITY_CACHE_SIZE', '4096'))
+
+# Pragmas applied once to every new connection
+CONNECTION_PRAGMAS = (
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-8000",  # 8 MiB page cache per connection
+    "PRAGMA mmap_size=67108864",  # Map up to 64 MiB of the database file
+)
+
+# Every handler runs on a worker thread of the dispatcher, each of them keeps its own connection for its lifetime
+_local = threading.local()
+_connections = []
+_connections_lock = threading.Lock()
+_generation = 0  # Bumped by close_connections() so threads drop connections that were closed underneath them
+connection_stats = {'opened': 0, 'reused': 0, 'closed': 0}
+
+_writer = None  # The _Writer thread once start_storage() has been called
 
+logger = logging.getLogger(__name__)
 
+_game_versions = {}  # Game id -> number of committed changes to that game since the bot started
+_game_versions_lock = threading.Lock()
+
+
+class _EntityCache:
+    """ Bounded LRU cache for the results of frequently called read functions
+
+    Every result is stored with tags like ('game', 42) or ('user', 1234) naming what it was read
+    from, write operations invalidate the tags they touched once they have been committed.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()  # Key -> (result, tags)
+        self.keys_by_tag = {}
+        self.epoch = 0  # Bumped by every invalidation, results read before one are not stored
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'invalidations': 0, 'evictions': 0}
+
+    def get(self, key):
+        """ :return: (True, result) if the key is cached, otherwise (False, epoch to pass to put) """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return False, self.epoch
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return True, entry[0]
+
+    def put(self, key, result, tags, epoch):
+        with self.lock:
+            if epoch != self.epoch:  # Invalidated while it was being read, it might be stale already
+                return
+            self._remove(key)
+            self.entries[key] = (result, tags)
+            for tag in tags:
+                self.keys_by_tag.setdefault(tag, set()).add(key)
+            if len(self.entries) > self.size:
+                self._remove(next(iter(self.entries)))
+                self.stats['evictions'] += 1
+
+    def invalidate(self, tag):
+        with self.lock:
+            self.epoch += 1
+            self.stats['invalidations'] += 1
+            for key in self.keys_by_tag.pop(tag, ()):
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.epoch += 1
+            self.entries.clear()
+            self.keys_by_tag.clear()
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            for tag in entry[1]:
+                keys = self.keys_by_tag.get(tag)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self.keys_by_tag[tag]
+
+
+_entity_cache = _EntityCache(ENTITY_CACHE_SIZE)
+
+
+class _Writer(threading.Thread):
+    """ Owns the connection that writes to the database
+
+    Write operations are queued by the handler threads and executed here in batches,
+    each batch in a single transaction (group commit). A batch is committed once it is
+    full or WRITER_LINGER seconds after its first operation arrived, and right away with
+    whatever is queued already as soon as it holds an operation a caller waits for. Every
+    operation runs inside its own savepoint, so one failing operation does not take the rest
+    of the batch with it. Every write is sent here, so they are committed in the order they
+    were queued.
+    """
+
+    def __init__(self):
+        super().__init__(name='sqlite-writer', daemon=True)
+        self.jobs = queue.Queue()
+        self.stats = {'operations': 0, 'commits': 0, 'last_commit_seconds': 0.0, 'total_commit_seconds': 0.0}
+
+    def submit(self, func, args, kwargs, wait=True):
+        """ Queues a write operation
+
+        :param wait: block until the batch containing the operation has been committed and return its result,
+                     otherwise return None right away
+        """
+        future = Future()
+        self.jobs.put((func, args, kwargs, future, wait))
+        if wait:
+            return future.result()
+        future.add_done_callback(_log_failed_write)
+
+    def stop(self):
+        self.jobs.put(None)
+        self.join()
+
+    def run(self):
+        con, cur = connect()
+        _local.writing = True  # Writes nested inside an operation run directly in the current transaction
+        running = True
+        while running:
+            batch = [self.jobs.get()]
+            deadline = time.monotonic() + WRITER_LINGER
+            waited_for = batch[-1] is not None and batch[-1][4]
+            while len(batch) < WRITER_MAX_BATCH and batch[-1] is not None:
+                try:
+                    # Once a caller waits for the commit, only the operations queued already join the batch
+                    batch.append(self.jobs.get(timeout=0 if waited_for else max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+                waited_for = waited_for or (batch[-1] is not None and batch[-1][4])
+            if None in batch:  # Stop signal, finish the operations queued before it
+                running = False
+                batch = batch[:batch.index(None)]
+            if batch:
+                self._commit_batch(con, cur, batch)
+        con.close()
+
+    def _commit_batch(self, con, cur, batch):
+        start = time.perf_counter()
+        results = []
+        callbacks = []
+        try:
+            cur.execute("BEGIN IMMEDIATE")
+            for func, args, kwargs, future, wait in batch:
+                cur.execute("SAVEPOINT operation")
+                _local.after_commit = []
+                try:
+                    results.append((future, func(*args, **kwargs), None))
+                    cur.execute("RELEASE operation")
+                    callbacks.extend(_local.after_commit)
+                except Exception as e:
+                    cur.execute("ROLLBACK TO operation")
+                    cur.execute("RELEASE operation")
+                    results.append((future, None, e))
+            con.commit()
+        except Exception as e:  # The transaction itself failed, nothing in this batch was written
+            if con.in_transaction:
+                con.rollback()
+            results = [(future, None, e) for func, args, kwargs, future, wait in batch]
+            callbacks = []
+        for callback, args in callbacks:
+            callback(*args)
+        elapsed = time.perf_counter() - start
+        self.stats['operations'] += len(batch)
+        self.stats['commits'] += 1
+        self.stats['last_commit_seconds'] = elapsed
+        self.stats['total_commit_seconds'] += elapsed
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+
+def _log_failed_write(future):
+    if future.exception() is not None:
+        logger.error('Coalesced write operation failed', exc_info=future.exception())
+
+
+def write_operation(func=None, coalesce=False):
+    """ Decorator for every function that modifies the database
+
+    The function is executed on the writer thread, or on the calling thread until the writer
+    has been started. Either way it runs in a transaction that holds the write lock from the
+    start, is committed once it returns and is rolled back if it raises. Writes that are not
+    coalesced wait for their commit, which also commits every write queued before them.
+
+    With coalesce=True, meant for small idempotent updates, the caller does not wait for the
+    function to be committed.
+    Such functions take an additional sync=True keyword for callers that have to read their
+    own write, which then waits for the commit.
+    """
+    if func is None:
+        return functools.partial(write_operation, coalesce=coalesce)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        sync = kwargs.pop('sync', False) if coalesce else True
+        if getattr(_local, 'writing', False):  # Called from within another write operation
+            return func(*args, **kwargs)
+        if _writer is not None:
+            return _writer.submit(func, args, kwargs, wait=sync)
+        con, cur = connect()
+        _local.writing = True
+        _local.after_commit = []
+        try:
+            # Takes the write lock up front, so what the operation reads cannot change before it writes
+            cur.execute("BEGIN IMMEDIATE")
+            result = func(*args, **kwargs)
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+        finally:
+            _local.writing = False
+        for callback, callback_args in _local.after_commit:
+            callback(*callback_args)
+        return result
+    return wrapper
+
+
+def after_commit(callback, *args):
+    """ Calls the callback with the given arguments once the running write operation has been committed """
+    _local.after_commit.append((callback, args))
+
+
+def bump_game_version(game_id):
+    """ Marks that the state of a game has changed, e.g. after a kill, a dropout or a new task """
+    with _game_versions_lock:
+        _game_versions[game_id] = _game_versions.get(game_id, 0) + 1
+    _entity_cache.invalidate(('game', int(game_id)))
+
+
+def invalidate_user(user_id):
+    """ Drops the cached reads about a user after a change that only concerns them, e.g. their subscription """
+    _entity_cache.invalidate(('user', int(user_id)))
+
+
+def measured(func):
+    """ Decorator for the functions the handlers call, records the duration and the errors of every call
+    in the metrics and a span in the trace of the update, if it is traced
+
+    It is the outermost decorator, so cached reads are measured with their cache hits and writes
+    including the wait for their commit.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            db_call_errors.inc(function=func.__name__, error=type(e).__name__)
+            raise
+        finally:
+            end = time.perf_counter()
+            db_call_seconds.observe(end - start, function=func.__name__)
+            record_span('db', func.__name__, start, end)
+    return wrapper
+
+
+def cached_read(tags):
+    """ Decorator for read functions whose results are kept in the entity cache
+
+    Reads from within a write operation bypass the cache, they have to see the running transaction.
+    :param tags: called with the result and the arguments of the function, returns the tags that invalidate the result
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if ENTITY_CACHE_SIZE <= 0 or getattr(_local, 'writing', False):
+                return func(*args, **kwargs)
+            key = (func.__name__, args, tuple(sorted(kwargs.items())))
+            found, cached = _entity_cache.get(key)
+            if found:
+                return cached
+            result = func(*args, **kwargs)
+            _entity_cache.put(key, result, tags(result, *args, **kwargs), cached)
+            return result
+        return wrapper
+    return decorator
+
+
+def entity_cache_stats():
+    """ Returns the hit, miss, invalidation and eviction counters and the size of the entity cache """
+    with _entity_cache.lock:
+        return dict(_entity_cache.stats, entries=len(_entity_cache.entries), enabled=ENTITY_CACHE_SIZE > 0)
+
+
+def get_game_version(game_id):
+    """ Returns a number that increases every time the state of the game changes, for cache invalidation """
+    return _game_versions.get(game_id, 0)
+
+
+def migrate():
+    """ Applies every migration in MIGRATIONS_DIR that is newer than the database
+
+    Migrations are named <version>_<description>.sql and the version of the database
+    is tracked in PRAGMA user_version. Each migration runs in its own transaction, so a
+    failing one leaves the database at the previous version.
+    :return: the schema version of the database after migrating
+    """
+    con = sqlite3.connect(DB_FILE, timeout=BUSY_TIMEOUT)
+    try:
+        version = con.execute("PRAGMA user_version").fetchone()[0]
+        for file_name in sorted(os.listdir(MIGRATIONS_DIR)):
+            migration_version = int(file_name.split('_')[0])
+            if migration_version > version:
+                with open(os.path.join(MIGRATIONS_DIR, file_name)) as migration:
+                    script = migration.read()
+                con.executescript("BEGIN IMMEDIATE;\n{}\nPRAGMA user_version={};\nCOMMIT;".format(
+                    script, migration_version))
+                version = migration_version
+    finally:
+        con.close()  # Rolls back a migration that failed halfway
+    return version
+
+
+def start_storage():
+    """ Prepares the database for the configured STORAGE_MODE and starts the writer thread,
+    to be called once before the bot starts
+    """
+    global _writer
+    if _writer is None:
+        if STORAGE_MODE == 'wal':
+            con, cur = connect()
+            cur.execute("PRAGMA journal_mode=WAL")  # Persisted in the database file
+        _writer = _Writer()
+        _writer.start()
+
+
+def writer_stats():
+    """ Returns the queue depth and commit latencies of the writer thread, None if it has not been started """
+    if _writer is None:
+        return None
+    stats = dict(_writer.stats)
+    stats['queue_depth'] = _writer.jobs.qsize()
+    stats['average_commit_seconds'] = stats['total_commit_seconds'] / stats['commits'] if stats['commits'] else 0.0
+    return stats
+
+
+@measured
+@cached_read(lambda result: [('admins',)])
 def get_developers():
     """ Gets a list of developer id's (e.g. for checking privileges)
     :return: a list of telegram IDs of registered developers
@@ -14,12 +392,15 @@ def get_developers():
     return [i[0] for i in cur.execute("SELECT id FROM Admins").fetchall()]
 
 
+@measured
+@write_operation(coalesce=True)
 def add_task(game_id, message, solution):
     con, cur = connect()
     cur.execute("INSERT INTO Task (message, solution, game) VALUES (?, ?, ?);", (message, solution, game_id))
-    con.commit()
+    after_commit(bump_game_version, game_id)
 
 
+@measured
 def get_active_task(game_id):
     con, cur = connect()
     fields = cur.execute("SELECT id, message, solution FROM Task WHERE game=? AND active=1", (game_id,)).fetchone()
@@ -33,25 +414,31 @@ def get_active_task(game_id):
         return None
 
 
+@measured
+@write_operation
 def set_task_inactive(game_id):
     con, cur = connect()
     cur.execute("UPDATE Task SET active=0 WHERE game=? AND active=1", (game_id,))
     cur.execute("UPDATE Assassins SET jokers_used=jokers_used+1 WHERE task_answered=0 AND target IS NOT NULL AND game=?", (game_id,))
     cur.execute("UPDATE Assassins SET task_answered=0 WHERE game=?", (game_id,))
-    con.commit()
+    after_commit(bump_game_version, game_id)
 
 
+@measured
 def get_three_joker_users(game_id):
     con, cur = connect()
     return [i[0] for i in cur.execute("SELECT id FROM Assassins WHERE jokers_used=3 AND target IS NOT NULL AND game=?", (game_id,)).fetchall()]
 
 
+@measured
+@write_operation(coalesce=True)
 def give_task_point(user_id):
     con, cur = connect()
     cur.execute("UPDATE Assassins SET task_answered=1 WHERE id=?", (user_id,))
-    con.commit()
 
 
+@measured
+@write_operation
 def add_game(game_id, master_id, master_name):
     """ Tries to add a game with the provided parameters
     :return: True if the insert was successful, False if it couldn't be inserted due to duplicates
@@ -60,28 +447,42 @@ def add_game(game_id, master_id, master_name):
     try:
         cur.execute("INSERT INTO Games(id, game_master_id, game_master_user) VALUES (?, ?, ?)",
                     (game_id, master_id, master_name,))
-        con.commit()
+        after_commit(bump_game_version, game_id)
+        after_commit(invalidate_user, master_id)
         return True
     except sqlite3.IntegrityError:
         return False
 
 
+@measured
+@write_operation
 def db_start_game(game_id):
+    """ Starts a game and assigns the targets in the same transaction, so the game is never seen started
+    without its ring
+    :return: the dossiers of every assassin, as returned by assign_targets
+    """
     con, cur = connect()
     cur.execute("UPDATE Games SET started=1 WHERE id=?", (game_id,))
-    con.commit()
+    after_commit(bump_game_version, game_id)
+    return assign_targets(game_id)
 
 
+@measured
+@cached_read(lambda result, game_id: [('game', int(game_id))])
 def game_exists(game_id):
     con, cur = connect()
     return cur.execute("SELECT * FROM Games WHERE id=?", (game_id,)).fetchone()
 
 
+@measured
+@cached_read(lambda result, game_id: [('game', int(game_id))])
 def game_started(game_id):
     con, cur = connect()
     return cur.execute("SELECT * FROM Games WHERE id=? AND started=1", (game_id,)).fetchone()
 
 
+@measured
+@cached_read(lambda result, user_id: [('user', int(user_id))] + ([('game', result['game'])] if result else []))
 def get_assassin(user_id):
     con, cur = connect()
     field_list = cur.execute("SELECT id, name, code_name, target, presumed_dead, tally, subscribed, game "
@@ -101,18 +502,23 @@ def get_assassin(user_id):
         return None
 
 
+@measured
 def last_man_standing(game_id):
     """ Returns None if there are multiple people still in the game (i.e. no target assigned to themselves) """
     con, cur = connect()
     return cur.execute("SELECT id FROM Assassins WHERE target=id AND game = ?", (game_id,)).fetchone()
 
 
+@measured
+@write_operation(coalesce=True)
 def set_presumed_dead(user_id):
     con, cur = connect()
     cur.execute("UPDATE Assassins SET presumed_dead=1 WHERE id = ?", (user_id,))
-    con.commit()
+    after_commit(invalidate_user, user_id)
 
 
+@measured
+@cached_read(lambda result, game_id: [('game', int(game_id))])
 def get_master(game_id):
     con, cur = connect()
     field_list = cur.execute("SELECT game_master_id, game_master_user FROM Games WHERE id=?", (game_id,)).fetchone()
@@ -125,57 +531,216 @@ def get_master(game_id):
         return None
 
 
+@measured
 def get_hunter(user_id):
     """ Return the user who is currently hunting this one"""
     con, cur = connect()
-    hunter_id = cur.execute("SELECT id FROM Assassins WHERE target=?", (user_id,)).fetchone()[0]
+    hunter_id = cur.execute("SELECT hunter FROM Assassins WHERE id=?", (user_id,)).fetchone()[0]
     return get_assassin(hunter_id)
 
 
-def add_assassin(chat_id, name, code_name, address, studies, weapon, game_id):
+@measured
+@write_operation
+def add_assassin(chat_id, name, code_name, address, studies, weapon, game_id, photo_file_id=None):
+    """ Signs a player up for a game that has not started yet
+
+    :return: True if the player was added, False if they are signed up already or the game has started
+    """
     con, cur = connect()
     try:
-        cur.execute("INSERT INTO Assassins(id, name, code_name, address, major, needs_weapon, game)"
-                    " VALUES (?, ?, ?, ?, ?, ?, ?)", (chat_id, name, code_name, address, studies, weapon, game_id,))
-        con.commit()
+        # Checked in the same statement, the targets of a game are only assigned once when it starts
+        cur.execute("INSERT INTO Assassins(id, name, code_name, address, major, needs_weapon, game, photo_file_id)"
+                    " SELECT ?, ?, ?, ?, ?, ?, id, ? FROM Games WHERE id=? AND started=0",
+                    (chat_id, name, code_name, address, studies, weapon, photo_file_id, game_id,))
+        if cur.rowcount != 1:
+            return False
+        after_commit(bump_game_version, game_id)
+        after_commit(invalidate_user, chat_id)
         return True
     except sqlite3.IntegrityError:
         return False
 
 
-def kill_player(dead_id, killer_id=None):
+@measured
+@write_operation
+def kill_player(dead_id, assassinated=False):
+    """ Kills off the person specified and splices them out of the target ring in one transaction
+
+    If the game has not started yet, the player is simply removed instead.
+    :param assassinated: True if the player was assassinated, which awards a kill to their hunter
+    :return: None if the player was removed or is not alive, otherwise a dict with the
+             hunter ({'id', 'code_name', 'tally'} after the kill), the hunter's new target as
+             returned by get_target_of and whether the hunter is now the last man standing
+    """
     con, cur = connect()
-    #  Kills off the person specified
-    if not game_started(get_game_id(participant_id=dead_id)):
+    game_id = get_game_id(participant_id=dead_id)
+    if not game_started(game_id):
         remove_player(dead_id)
-    else:
-        # Update target of hunter
-        cur.execute("UPDATE Assassins "
-                    "SET target=(SELECT target FROM Assassins WHERE id=?) "
-                    "WHERE target=?;",
-                    (dead_id, dead_id,))
-        # Kill off player by setting target to NULL
-        cur.execute("UPDATE Assassins "
-                    "SET target=NULL, presumed_dead=0 "
-                    "WHERE id=?;", (dead_id,))
-        if killer_id:  # User has been assassinated and there are points to award
-            cur.execute("UPDATE Assassins SET tally=tally+1 where id=?", (killer_id,))
-        con.commit()
+        return None
+    # Update target of hunter, this takes the write lock before anything about the ring is read
+    hunter = cur.execute("UPDATE Assassins "
+                         "SET target=(SELECT target FROM Assassins WHERE id=?), tally=tally+? "
+                         "WHERE id=(SELECT hunter FROM Assassins WHERE id=? AND target IS NOT NULL) AND id<>? "
+                         "RETURNING id, code_name, tally, target;",
+                         (dead_id, 1 if assassinated else 0, dead_id, dead_id,)).fetchone()
+    # Kill off player by setting target to NULL
+    cur.execute("UPDATE Assassins "
+                "SET target=NULL, hunter=NULL, presumed_dead=0 "
+                "WHERE id=?;", (dead_id,))
+    after_commit(bump_game_version, game_id)
+    if hunter is None:  # Already dead, or the last one alive and nobody is left to take over their target
+        return None
+    # The new target of the hunter is now hunted by them
+    cur.execute("UPDATE Assassins SET hunter=? WHERE id=?", (hunter[0], hunter[3],))
+    new_target = cur.execute("SELECT id, name, code_name, address, major, game, photo_file_id FROM Assassins "
+                             "WHERE id=?", (hunter[3],)).fetchone()
+    return {
+        'hunter': {
+            'id': hunter[0],
+            'code_name': hunter[1],
+            'tally': hunter[2],
+        },
+        'target': new_target,
+        'game_over': hunter[0] == new_target[0],
+    }
+
+
+@measured
+@write_operation(coalesce=True)
+def set_photo_file_id(user_id, photo_file_id):
+    """ Remembers the Telegram file_id of the photo of an assassin after it has been uploaded """
+    con, cur = connect()
+    cur.execute("UPDATE Assassins SET photo_file_id=? WHERE id=?", (photo_file_id, user_id,))
 
 
+@measured
+@write_operation
+def kill_players(game_id, dead_ids):
+    """ Kills off many players of one game at once, splicing all of them out of the ring in a single pass
+
+    Each surviving hunter is handed the first player alive after the run of dead players in
+    front of them, so even adjacent players are removed correctly and every hunter gets their
+    final target exactly once. If the game has not started yet, the players are removed instead.
+    :return: a dict with the ids of the players that were 'killed' (players not alive in this game are
+             skipped), 'retargeted' as a list of (hunter_id, new target as returned by get_target_details)
+             and whether this call ended the game by leaving at most one player alive
+    """
+    con, cur = connect()
+    if not game_started(game_id):
+        killed = []
+        for dead_id in dead_ids:
+            if cur.execute("DELETE FROM Assassins WHERE id=? AND game=? RETURNING id", (dead_id, game_id,)).fetchone():
+                killed.append(dead_id)
+        after_commit(bump_game_version, game_id)
+        return {'killed': killed, 'retargeted': [], 'game_over': False}
+    targets = dict(cur.execute("SELECT id, target FROM Assassins WHERE game=? AND target IS NOT NULL",
+                               (game_id,)).fetchall())
+    dead = {dead_id for dead_id in dead_ids if dead_id in targets}
+    new_targets = {}
+    for assassin_id, target in targets.items():
+        if assassin_id not in dead and target in dead:
+            # Every dead player is skipped by exactly one hunter, so this is a single pass over the ring
+            while target in dead:
+                target = targets[target]
+            new_targets[assassin_id] = target
+    cur.executemany("UPDATE Assassins SET target=NULL, hunter=NULL, presumed_dead=0 WHERE id=?",
+                    [(dead_id,) for dead_id in dead])
+    cur.executemany("UPDATE Assassins SET target=? WHERE id=?",
+                    [(target, hunter_id) for hunter_id, target in new_targets.items()])
+    cur.executemany("UPDATE Assassins SET hunter=? WHERE id=?",
+                    [(hunter_id, target) for hunter_id, target in new_targets.items()])
+    after_commit(bump_game_version, game_id)
+    details = {}
+    if new_targets:
+        details = {row[0]: row for row in cur.execute(
+            "SELECT id, name, code_name, address, major, game, photo_file_id FROM Assassins WHERE id IN ({})".format(
+                ', '.join('?' * len(new_targets))), list(new_targets.values())).fetchall()}
+    return {
+        'killed': list(dead),
+        'retargeted': [(hunter_id, details[target]) for hunter_id, target in new_targets.items()],
+        'game_over': bool(dead) and len(targets) - len(dead) <= 1,  # Only reported by the call that ended it
+    }
+
+
+@measured
+@write_operation
 def remove_player(user_id):
     con, cur = connect()
-    cur.execute("DELETE FROM Assassins WHERE id = ?", (user_id,))
-    con.commit()
+    removed = cur.execute("DELETE FROM Assassins WHERE id = ? RETURNING game", (user_id,)).fetchone()
+    if removed:
+        after_commit(bump_game_version, removed[0])
 
 
+@measured
 def get_target_of(chat_id):
     con, cur = connect()
     target_id = cur.execute("SELECT target FROM Assassins WHERE id=?", (chat_id,)).fetchone()[0]
-    return cur.execute(
-        "SELECT id, name, code_name, address, major, game FROM Assassins WHERE id=?", (target_id,)).fetchone()
+    return get_target_details(target_id)
+
+
+@measured
+def get_target_details(target_id):
+    """ Gets what the dossier shows about a player
+    :return: (target_id, name, code_name, address, major, game, photo_file_id)
+    """
+    con, cur = connect()
+    return cur.execute("SELECT id, name, code_name, address, major, game, photo_file_id FROM Assassins WHERE id=?",
+                       (target_id,)).fetchone()
+
+
+@measured
+def get_ring_state(game_id):
+    """ Gets everything the in-memory game engine keeps about the players of a game
+    :return: a list of (id, code_name, target, hunter, tally, presumed_dead) tuples
+    """
+    con, cur = connect()
+    return cur.execute("SELECT id, code_name, target, hunter, tally, presumed_dead FROM Assassins "
+                       "WHERE game=? ORDER BY id", (game_id,)).fetchall()
 
 
+@measured
+def check_ring(game_id):
+    """ Checks that the target and hunter pointers of a game form a single consistent ring of all players alive
+    :return: a list of the inconsistencies found, empty if there are none
+    """
+    con, cur = connect()
+    rows = cur.execute("SELECT id, target, hunter FROM Assassins WHERE game=? AND target IS NOT NULL",
+                       (game_id,)).fetchall()
+    targets = {assassin_id: target for assassin_id, target, hunter in rows}
+    hunters = {assassin_id: hunter for assassin_id, target, hunter in rows}
+    problems = []
+    for assassin_id, target in targets.items():
+        if target not in targets:
+            problems.append('{} hunts {}, who is not alive in this game'.format(assassin_id, target))
+        elif hunters[target] != assassin_id:
+            problems.append('{} hunts {}, but {} is hunted by {}'.format(assassin_id, target, target, hunters[target]))
+    if rows and not problems:
+        # Every pointer pair is consistent, so the players form disjoint rings, there must only be one
+        assassin_id, ring_length = rows[0][0], 0
+        while True:
+            assassin_id, ring_length = targets[assassin_id], ring_length + 1
+            if assassin_id == rows[0][0]:
+                break
+        if ring_length != len(rows):
+            problems.append('The ring of {} only contains {} of {} players alive'.format(
+                rows[0][0], ring_length, len(rows)))
+    return problems
+
+
+@measured
+def get_dossiers(game_id):
+    """ Gets the target of every assassin alive in the game in a single query
+    :return: a list of (assassin_id, target_id, name, code_name, address, major, game, photo_file_id), where
+             everything after the assassin_id is the target as returned by get_target_of
+    """
+    con, cur = connect()
+    return cur.execute("SELECT Assassins.id, Target.id, Target.name, Target.code_name, Target.address, Target.major, "
+                       "Target.game, Target.photo_file_id "
+                       "FROM Assassins INNER JOIN Assassins AS Target ON Target.id=Assassins.target "
+                       "WHERE Assassins.game=?", (game_id,)).fetchall()
+
+
+@measured
 def get_assassin_ids(game_id, only_alive=False):
     con, cur = connect()
     if only_alive:  # Only return assassins that are alive
@@ -185,6 +750,18 @@ def get_assassin_ids(game_id, only_alive=False):
         return [i[0] for i in cur.execute("SELECT id FROM Assassins WHERE game=?", (game_id,)).fetchall()]
 
 
+@measured
+def get_leaderboard_rows(game_id):
+    """ Gets the leaderboard of a game, sorted first by alive/dead and second by number of kills
+    :return: a list of (rank, alive, code_name, tally) tuples, players with the same status and tally share a rank
+    """
+    con, cur = connect()
+    return cur.execute("SELECT RANK() OVER (ORDER BY target IS NULL, tally DESC), target IS NOT NULL, code_name, tally "
+                       "FROM Assassins WHERE game=? "
+                       "ORDER BY target IS NULL, tally DESC, code_name", (game_id,)).fetchall()
+
+
+@measured
 def get_game_id(game_master_id=None, participant_id=None):
     con, cur = connect()
     if game_master_id:
@@ -203,31 +780,161 @@ def get_game_id(game_master_id=None, participant_id=None):
             return None
 
 
+def _session_tags(session, user_id):
+    tags = [('user', int(user_id))]
+    if session['game_id'] is not None:
+        tags.append(('game', session['game_id']))
+    if session['assassin'] is not None and session['assassin']['game'] != session['game_id']:
+        tags.append(('game', session['assassin']['game']))
+    return tags
+
+
+@measured
+@cached_read(_session_tags)
+def get_session(user_id):
+    """ Resolves everything the handlers need to know about a user with a single query
+
+    A user that is both a game master and a participant is treated as the master, their assassin record is
+    still included. The result is cached and shared between updates, it must not be modified.
+    :return: a dict with the 'role' of the user ('master', 'participant' or None), the 'game_id', 'started' flag and
+             'active_task' of the game they have that role in, whether they are 'alive' (have a target) and their
+             'assassin' record, which also holds 'started', 'master_id', 'master_user' and 'active_task' of their game
+    """
+    con, cur = connect()
+    rows = cur.execute(
+        "SELECT 'master', Games.id, Games.started, Games.game_master_id, Games.game_master_user, "
+        "Task.id, Task.message, Task.solution, NULL, NULL, NULL, NULL, NULL, NULL, NULL "
+        "FROM Games LEFT JOIN Task ON Task.game=Games.id AND Task.active=1 WHERE Games.game_master_id=? "
+        "UNION ALL "
+        "SELECT 'participant', Games.id, Games.started, Games.game_master_id, Games.game_master_user, "
+        "Task.id, Task.message, Task.solution, Assassins.id, Assassins.name, Assassins.code_name, Assassins.target, "
+        "Assassins.presumed_dead, Assassins.tally, Assassins.subscribed "
+        "FROM Assassins INNER JOIN Games ON Games.id=Assassins.game "
+        "LEFT JOIN Task ON Task.game=Games.id AND Task.active=1 WHERE Assassins.id=? "
+        "ORDER BY 1", (user_id, user_id)).fetchall()
+    session = {'role': None, 'game_id': None, 'started': False, 'alive': False, 'active_task': None, 'assassin': None}
+    for row in rows:
+        active_task = {'id': row[5], 'message': row[6], 'solution': row[7]} if row[5] is not None else None
+        if row[0] == 'participant' and session['assassin'] is None:
+            session['assassin'] = {
+                'id': row[8],
+                'name': row[9],
+                'code_name': row[10],
+                'target': row[11],
+                'presumed_dead': row[12],
+                'tally': row[13],
+                'subscribed': row[14],
+                'game': row[1],
+                'started': row[2] == 1,
+                'master_id': row[3],
+                'master_user': row[4],
+                'active_task': active_task,
+            }
+            session['alive'] = row[11] is not None
+        if session['role'] is None:
+            session.update(role=row[0], game_id=row[1], started=row[2] == 1, active_task=active_task)
+    return session
+
+
+@measured
+def count_started_games():
+    """ Returns the number of games that are running right now """
+    con, cur = connect()
+    return cur.execute("SELECT COUNT(*) FROM Games WHERE started=1").fetchone()[0]
+
+
+@measured
 def get_subscribers(game_id):
     con, cur = connect()
     return [i[0] for i in cur.execute("SELECT id FROM Assassins WHERE game=? AND subscribed=1", (game_id,)).fetchall()]
 
 
+@measured
+@write_operation
 def assign_targets(game_id):
+    """ Shuffles the assassins of a game into a ring where everyone hunts the next one
+
+    All targets are written in one statement, and the resulting assignment is read back
+    in one query so the dossiers can be sent out without querying every single target.
+    :return: the dossiers of every assassin, as returned by get_dossiers
+    """
     con, cur = connect()
     assassins = get_assassin_ids(game_id)
-    for i in range(len(assassins)):
-        cur.execute("UPDATE Assassins SET target=? WHERE id=?", ((assassins[(i + 1) % len(assassins)]), assassins[i],))
-    con.commit()
+    random.shuffle(assassins)
+    cur.executemany("UPDATE Assassins SET target=?, hunter=? WHERE id=?",
+                    [(assassins[(i + 1) % len(assassins)], assassins[i - 1], assassins[i])
+                     for i in range(len(assassins))])
+    after_commit(bump_game_version, game_id)
+    return get_dossiers(game_id)
 
 
-def change_subscription(user_id):
+@measured
+@write_operation(coalesce=True)
+def change_subscription(user_id, subscribed):
     con, cur = connect()
-    cur.execute("UPDATE Assassins SET subscribed = (subscribed+1)%2 WHERE id=?", (user_id,))
-    con.commit()
+    cur.execute("UPDATE Assassins SET subscribed=? WHERE id=?", (1 if subscribed else 0, user_id,))
+    after_commit(invalidate_user, user_id)
 
 
+@measured
+@write_operation
 def set_game_stopped(game_id):
     con, cur = connect()
     cur.execute("UPDATE Games SET started=0 WHERE id=?", (game_id,))
-    con.commit()
+    after_commit(bump_game_version, game_id)
 
 
 def connect():
-    con = sqlite3.connect(DB_FILE)
+    """ Returns the connection of the calling thread and a fresh cursor on it
+
+    The connection is opened on the first call from a thread and reused for every
+    call after that, until close_connections() is called on shutdown
+    """
+    con = getattr(_local, 'con', None)
+    if con is None or getattr(_local, 'generation', None) != _generation:
+        # check_same_thread is disabled so close_connections() can close it from the main thread
+        con = sqlite3.connect(DB_FILE, timeout=BUSY_TIMEOUT, cached_statements=STATEMENT_CACHE_SIZE,
+                              check_same_thread=False)
+        for pragma in CONNECTION_PRAGMAS:
+            con.execute(pragma)
+        if STORAGE_MODE == 'wal':
+            con.execute("PRAGMA synchronous=NORMAL")  # Durable enough in WAL mode and saves an fsync per commit
+        _local.con = con
+        _local.generation = _generation
+        with _connections_lock:
+            _connections.append(con)
+            connection_stats['opened'] += 1
+    else:
+        with _connections_lock:
+            connection_stats['reused'] += 1
     return con, con.cursor()
+
+
+def set_database(db_file):
+    """ Switches to another database file, e.g. a throwaway one for benchmarks or replays
+
+    Every connection is closed, the writer thread is stopped until start_storage() is called again and
+    what is cached about the previous database is dropped, so it must not be called while updates are
+    being handled.
+    """
+    global DB_FILE
+    close_connections()
+    DB_FILE = db_file
+    _entity_cache.clear()
+    with _game_versions_lock:
+        for game_id in _game_versions:
+            _game_versions[game_id] += 1
+
+
+def close_connections():
+    """ Closes every connection opened by connect(), to be called once the bot shuts down """
+    global _generation, _writer
+    if _writer is not None:  # Let the writer commit what is still queued
+        _writer.stop()
+        _writer = None
+    with _connections_lock:
+        for con in _connections:
+            con.close()
+        connection_stats['closed'] += len(_connections)
+        _connections.clear()
+        _generation += 1
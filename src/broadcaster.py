@@ -0,0 +1,181 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram.error import (RetryAfter, TelegramError, Unauthorized)
+
+from src.tracing import current_trace, traced, record_span
+
+# Telegram allows bots about 30 messages per second overall and about one per second in a single chat
+GLOBAL_RATE = 30
+PER_CHAT_RATE = 1
+PER_CHAT_BURST = 3
+
+# How often a message is retried after Telegram asked us to slow down
+MAX_RETRIES = 5
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """ Blocking token bucket, acquire() returns once sending one more message is within the rate """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """ Hands out no tokens for the given time, e.g. after Telegram answered with RetryAfter """
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+    def full(self):
+        with self.lock:
+            return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+
+class _Batch:
+    """ Progress of one broadcast, reports to the game master once every chat has been handled """
+
+    def __init__(self, chats, report_to, description):
+        self.remaining = chats
+        self.delivered = 0
+        self.failed = 0
+        self.report_to = report_to
+        self.description = description
+        self.lock = threading.Lock()
+
+    def chat_done(self, bot, delivered):
+        with self.lock:
+            if delivered:
+                self.delivered += 1
+            else:
+                self.failed += 1
+            self.remaining -= 1
+            finished = self.remaining == 0
+        if finished:
+            self.report(bot)
+
+    def report(self, bot):
+        if self.report_to is not None:
+            try:
+                bot.send_message(self.report_to, '{} reached {} players, {} could not be contacted'.format(
+                    self.description, self.delivered, self.failed))
+            except TelegramError:
+                logger.warning('Broadcast report could not be sent to {}'.format(self.report_to))
+
+
+class Broadcaster:
+    """ Sends messages to many players in the background without exceeding Telegram's rate limits
+
+    Messages are sent concurrently by a pool of worker threads. The messages for one chat
+    are sent in order by a single worker, different chats are served in parallel.
+    """
+
+    def __init__(self, workers=8):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='broadcast')
+        self.global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_RATE)
+        self.chat_buckets = {}
+        self.chat_buckets_lock = threading.Lock()
+
+    def broadcast(self, bot, jobs, report_to=None, description='Your message'):
+        """ Queues messages for sending and returns immediately
+
+        :param jobs: iterable of (chat_id, payload) where the payload holds the keyword arguments for
+                     send_photo if it contains a 'photo' and for send_message otherwise. A photo given as a
+                     path is only opened once it is sent. An optional 'on_sent' in the payload is called
+                     with the sent message
+        :param report_to: chat id that is told how many players were reached once everything has been sent
+        :param description: what is being sent, used in the report
+        :return: the number of chats the messages are sent to
+        """
+        payloads_per_chat = {}
+        for chat_id, payload in jobs:
+            payloads_per_chat.setdefault(chat_id, []).append(payload)
+        batch = _Batch(len(payloads_per_chat), report_to, description)
+        trace_id = current_trace()  # The messages are sent in the trace of the update that queued them
+        for chat_id, payloads in payloads_per_chat.items():
+            self.executor.submit(self._deliver, bot, chat_id, payloads, batch, trace_id)
+        if not payloads_per_chat:
+            batch.report(bot)
+        return len(payloads_per_chat)
+
+    def shutdown(self):
+        """ Waits until every queued message has been sent """
+        self.executor.shutdown(wait=True)
+
+    def _deliver(self, bot, chat_id, payloads, batch, trace_id):
+        with traced(trace_id):
+            start = time.perf_counter()
+            delivered = True
+            try:
+                for payload in payloads:
+                    if not self._send(bot, chat_id, payload):
+                        delivered = False
+                        break
+            except Exception:
+                logger.exception('Broadcasting to {} failed'.format(chat_id))
+                delivered = False
+            record_span('broadcast', 'deliver', start, time.perf_counter(), messages=len(payloads),
+                        delivered=delivered)
+            batch.chat_done(bot, delivered)
+
+    def _send(self, bot, chat_id, payload):
+        payload = dict(payload)
+        on_sent = payload.pop('on_sent', None)
+        chat_bucket = self._chat_bucket(chat_id)
+        for attempt in range(MAX_RETRIES + 1):
+            chat_bucket.acquire()
+            self.global_bucket.acquire()
+            try:
+                if 'photo' in payload:
+                    photo = payload['photo']
+                    if isinstance(photo, os.PathLike):
+                        with open(photo, 'rb') as photo_file:
+                            message = bot.send_photo(chat_id, **dict(payload, photo=photo_file))
+                    else:
+                        message = bot.send_photo(chat_id, **payload)
+                else:
+                    message = bot.send_message(chat_id, **payload)
+                if on_sent:
+                    on_sent(message)
+                return True
+            except RetryAfter as e:
+                # The flood limit applies to the whole bot, so every worker has to back off
+                logger.warning('Flood limit reached, pausing broadcasts for {}s'.format(e.retry_after))
+                self.global_bucket.pause(e.retry_after)
+            except Unauthorized:
+                logger.warning('User {} could not be contacted'.format(chat_id))
+                return False
+            except TelegramError as e:
+                logger.warning('Sending to {} failed: {}'.format(chat_id, e))
+                return False
+        return False
+
+    def _chat_bucket(self, chat_id):
+        with self.chat_buckets_lock:
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is None:
+                if len(self.chat_buckets) > 10000:  # Forget chats that have not been written to recently
+                    self.chat_buckets = {k: v for k, v in self.chat_buckets.items() if not v.full()}
+                bucket = self.chat_buckets[chat_id] = TokenBucket(PER_CHAT_RATE, PER_CHAT_BURST)
+            return bucket
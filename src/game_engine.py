@@ -0,0 +1,153 @@
+import logging
+import threading
+from array import array
+
+from src.bot_database_interface import game_started, get_ring_state, check_ring, kill_player, kill_players, \
+    set_presumed_dead
+
+NO_SLOT = -1  # Target and hunter of players that are dead
+
+_rings = {}  # Game id -> GameRing of every started game that has been used since the bot started
+_rings_lock = threading.Lock()
+
+logger = logging.getLogger(__name__)
+
+
+class GameRing:
+    """ In-memory state of the target ring of a started game
+
+    Players are numbered with dense slots and their state is kept in compact arrays indexed
+    by slot, so lookups, alive counts and the leaderboard need no database queries. Changes
+    are written through to the database first and then applied to the arrays, all of them
+    have to go through this class while the ring is loaded.
+    """
+
+    def __init__(self, game_id, rows):
+        """ :param rows: the players of the game as returned by get_ring_state """
+        self.game_id = game_id
+        self.lock = threading.Lock()
+        self.ids = array('q', (row[0] for row in rows))
+        self.slots = {assassin_id: slot for slot, assassin_id in enumerate(self.ids)}
+        self.code_names = [row[1] for row in rows]
+        self.target = array('q', (self.slots.get(row[2], NO_SLOT) for row in rows))
+        self.hunter = array('q', (self.slots.get(row[3], NO_SLOT) for row in rows))
+        self.tally = array('l', (row[4] for row in rows))
+        self.alive = array('b', (row[2] is not None for row in rows))
+        self.presumed_dead = array('b', (row[5] for row in rows))
+        self.alive_count = sum(self.alive)
+
+    def is_alive(self, assassin_id):
+        slot = self.slots.get(assassin_id)
+        return slot is not None and self.alive[slot] == 1
+
+    def target_of(self, assassin_id):
+        """ Returns the id of the target of a player, None if they are dead """
+        slot = self.slots.get(assassin_id)
+        if slot is None or self.target[slot] == NO_SLOT:
+            return None
+        return self.ids[self.target[slot]]
+
+    def hunter_of(self, assassin_id):
+        """ Returns the id of the player hunting this one, None if they are dead """
+        slot = self.slots.get(assassin_id)
+        if slot is None or self.hunter[slot] == NO_SLOT:
+            return None
+        return self.ids[self.hunter[slot]]
+
+    def is_presumed_dead(self, assassin_id):
+        slot = self.slots.get(assassin_id)
+        return slot is not None and self.presumed_dead[slot] == 1
+
+    def last_man_standing(self):
+        """ Returns the id of the only player alive, None if there are multiple people still in the game """
+        if self.alive_count != 1:
+            return None
+        return self.ids[self.alive.index(1)]
+
+    def leaderboard_rows(self):
+        """ Same as get_leaderboard_rows, computed from memory """
+        order = sorted(range(len(self.ids)), key=lambda slot: (not self.alive[slot], -self.tally[slot],
+                                                               self.code_names[slot]))
+        rows = []
+        for position, slot in enumerate(order):
+            if rows and rows[-1][1] == self.alive[slot] and rows[-1][3] == self.tally[slot]:
+                rank = rows[-1][0]  # Tied with the player above
+            else:
+                rank = position + 1
+            rows.append((rank, self.alive[slot], self.code_names[slot], self.tally[slot]))
+        return rows
+
+    def set_presumed_dead(self, assassin_id):
+        with self.lock:
+            set_presumed_dead(assassin_id, sync=True)
+            self.presumed_dead[self.slots[assassin_id]] = 1
+
+    def kill(self, dead_id, assassinated=False):
+        """ Kills off a player with kill_player and applies the change to the ring, returns what kill_player returns """
+        with self.lock:
+            result = kill_player(dead_id, assassinated=assassinated)
+            dead = self.slots.get(dead_id)
+            if dead is None or not self.alive[dead]:
+                return result
+            if result:
+                hunter = self.slots[result['hunter']['id']]
+                new_target = self.slots[result['target'][0]]
+                self.target[hunter] = new_target
+                self.hunter[new_target] = hunter
+                self.tally[hunter] = result['hunter']['tally']
+            self._mark_dead(dead)
+            return result
+
+    def kill_many(self, dead_ids):
+        """ Kills off many players at once with kill_players and applies the change to the ring """
+        with self.lock:
+            result = kill_players(self.game_id, dead_ids)
+            for hunter_id, target in result['retargeted']:
+                hunter, new_target = self.slots[hunter_id], self.slots[target[0]]
+                self.target[hunter] = new_target
+                self.hunter[new_target] = hunter
+            for dead_id in result['killed']:
+                self._mark_dead(self.slots[dead_id])
+            return result
+
+    def _mark_dead(self, dead):
+        self.target[dead] = self.hunter[dead] = NO_SLOT
+        self.alive[dead] = 0
+        self.presumed_dead[dead] = 0
+        self.alive_count -= 1
+
+
+def get_ring(game_id):
+    """ Returns the ring of a started game, loading it from the database on first use, None if it has not started """
+    ring = _rings.get(game_id)
+    if ring is None and game_started(game_id):
+        with _rings_lock:
+            ring = _rings.get(game_id)
+            if ring is None:
+                # Loaded once per game, a broken ring would otherwise only show as wrong dossiers later on
+                for problem in check_ring(game_id):
+                    logger.error('Inconsistent ring in game {}: {}'.format(game_id, problem))
+                ring = _rings[game_id] = GameRing(game_id, get_ring_state(game_id))
+    return ring
+
+
+def drop_ring(game_id):
+    """ Forgets the ring of a game once it has been stopped """
+    with _rings_lock:
+        _rings.pop(game_id, None)
+
+
+def eliminate(game_id, dead_id, assassinated=False):
+    """ Kills off a player through the ring of their game if it has started, see kill_player """
+    ring = get_ring(game_id)
+    if ring is None:
+        return kill_player(dead_id, assassinated=assassinated)
+    return ring.kill(dead_id, assassinated=assassinated)
+
+
+def eliminate_many(game_id, dead_ids):
+    """ Kills off many players of a game at once, through its ring if it has started, see kill_players """
+    ring = get_ring(game_id)
+    if ring is None:
+        return kill_players(game_id, dead_ids)
+    return ring.kill_many(dead_ids)
@@ -0,0 +1,88 @@
+import functools
+import threading
+import time
+from collections import deque
+
+
+class _Command:
+    """ A command in the lanes of its games """
+
+    def __init__(self, game_ids, func, schedule):
+        self.game_ids = game_ids
+        self.func = func
+        self.schedule = schedule
+        self.blocked = 0  # Lanes the command is not at the front of yet
+        self.queued_at = None  # Time it was queued, None if it ran right away
+
+
+class GameLanes:
+    """ Runs the mutating commands of one game strictly one after another, in the order they reach the lane
+
+    Each game has a queue of commands, like the mailbox of an actor. A command whose lanes are free
+    runs right away on the calling thread. Otherwise it is queued and the calling thread returns, so
+    waiting commands do not hold on to the worker threads of the dispatcher. Once a command is done,
+    the command behind it is handed to the function it was submitted with to run it on another thread,
+    e.g. the run_async of the dispatcher. A busy game thus holds at most one worker at a time and
+    commands of different games keep running in parallel. A lane only exists while commands are
+    queued in it.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.lanes = {}  # Game id -> deque of _Command, the first one is running
+        self.stats = {'commands': 0, 'waited': 0, 'total_wait_seconds': 0.0, 'max_depth': 0}
+
+    def submit(self, game_ids, func, schedule):
+        """ Runs func in the lanes of the given games, after every command submitted to them before
+
+        :param game_ids: the games the command may change, it is queued in all of them at once so commands
+                         spanning several games can not deadlock
+        :param func: the command, a function without arguments
+        :param schedule: function that runs a function without arguments on another thread, it is called
+                         once it is the turn of a command that had to be queued
+        :return: what func returned if it ran right away, None if it was queued
+        """
+        command = _Command(set(game_ids), func, schedule)
+        with self.lock:
+            for game_id in command.game_ids:
+                lane = self.lanes.setdefault(game_id, deque())
+                lane.append(command)
+                if len(lane) > 1:
+                    command.blocked += 1
+                self.stats['max_depth'] = max(self.stats['max_depth'], len(lane))
+            self.stats['commands'] += 1
+            if command.blocked:
+                self.stats['waited'] += 1
+                command.queued_at = time.perf_counter()
+                return None
+        return self._run(command)
+
+    def depths(self):
+        """ Returns the number of commands running or waiting in each lane, by game id """
+        with self.lock:
+            return {game_id: len(lane) for game_id, lane in self.lanes.items()}
+
+    def _run(self, command):
+        if command.queued_at is not None:
+            with self.lock:
+                self.stats['total_wait_seconds'] += time.perf_counter() - command.queued_at
+        try:
+            return command.func()
+        finally:
+            for next_command in self._release(command):
+                next_command.schedule(functools.partial(self._run, next_command))
+
+    def _release(self, command):
+        """ Takes a finished command out of its lanes, returns the commands whose turn it is now """
+        runnable = []
+        with self.lock:
+            for game_id in command.game_ids:
+                lane = self.lanes[game_id]
+                lane.popleft()
+                if not lane:
+                    del self.lanes[game_id]
+                    continue
+                lane[0].blocked -= 1
+                if lane[0].blocked == 0:
+                    runnable.append(lane[0])
+        return runnable
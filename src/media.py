@@ -0,0 +1,107 @@
+import io
+import logging
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram.error import (NetworkError)
+
+try:
+    from PIL import Image
+except ImportError:  # Without Pillow photos are stored the way Telegram sends them
+    Image = None
+
+# Longest side of the stored dossier photos in pixels, Telegram shows photos in chats at about this size
+PHOTO_SIZE = 800
+
+# Stored photos are re-encoded with lower quality until they fit into this many bytes
+MAX_PHOTO_BYTES = 200 * 1024
+JPEG_QUALITIES = (85, 75, 65, 50)
+
+# How often a download is attempted before the photo is given up on
+DOWNLOAD_ATTEMPTS = 3
+
+logger = logging.getLogger(__name__)
+
+
+def choose_photo_size(photo_sizes):
+    """ Picks the smallest of the sizes Telegram offers for a photo that is still at least PHOTO_SIZE large
+
+    :param photo_sizes: the PhotoSize list of a message, ordered from small to large
+    :return: the chosen PhotoSize, the largest one if none of them is large enough
+    """
+    for photo_size in photo_sizes:
+        if max(photo_size.width, photo_size.height) >= PHOTO_SIZE:
+            return photo_size
+    return photo_sizes[-1]
+
+
+def encode_photo(data):
+    """ Scales a photo down to PHOTO_SIZE and re-encodes it as a JPEG of at most MAX_PHOTO_BYTES if possible """
+    if Image is None:
+        return bytes(data)
+    image = Image.open(io.BytesIO(data)).convert('RGB')
+    image.thumbnail((PHOTO_SIZE, PHOTO_SIZE))
+    for quality in JPEG_QUALITIES:
+        encoded = io.BytesIO()
+        image.save(encoded, format='JPEG', quality=quality, optimize=True)
+        if encoded.tell() <= MAX_PHOTO_BYTES:
+            break
+    return encoded.getvalue()
+
+
+def write_atomically(path, data):
+    """ Writes the file under a temporary name first, so readers never see a half-written photo """
+    directory = os.path.dirname(path) or '.'
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(file_descriptor, 'wb') as temporary_file:
+            temporary_file.write(data)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+
+
+class PhotoIngester:
+    """ Downloads, shrinks and stores signup photos on a pool of background threads """
+
+    def __init__(self, workers=4):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='photos')
+        self.stats = {'queued': 0, 'stored': 0, 'failed': 0, 'bytes_stored': 0}
+        self.stats_lock = threading.Lock()
+
+    def enqueue(self, photo_size, path):
+        """ Queues the photo to be stored under the given path and returns immediately """
+        with self.stats_lock:
+            self.stats['queued'] += 1
+        self.executor.submit(self._ingest, photo_size, path)
+
+    def shutdown(self):
+        """ Waits until every queued photo has been stored """
+        self.executor.shutdown(wait=True)
+
+    def _ingest(self, photo_size, path):
+        try:
+            data = self._download(photo_size)
+            encoded = encode_photo(data)
+            write_atomically(path, encoded)
+        except Exception:
+            logger.exception('Photo {} could not be stored'.format(path))
+            with self.stats_lock:
+                self.stats['failed'] += 1
+            return
+        logger.info('Stored photo {} ({} bytes, downloaded {} bytes)'.format(path, len(encoded), len(data)))
+        with self.stats_lock:
+            self.stats['stored'] += 1
+            self.stats['bytes_stored'] += len(encoded)
+
+    @staticmethod
+    def _download(photo_size):
+        for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+            try:
+                return photo_size.get_file().download_as_bytearray()
+            except NetworkError:
+                if attempt == DOWNLOAD_ATTEMPTS:
+                    raise
@@ -0,0 +1,235 @@
+import bisect
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from telegram.error import TelegramError
+from telegram.utils.request import Request
+
+from src.tracing import record_span
+
+# Port of the HTTP endpoint that serves the metrics in the Prometheus text format, unset disables the endpoint
+METRICS_PORT = os.getenv('SAS_METRICS_PORT')
+METRICS_LISTEN = os.getenv('SAS_METRICS_LISTEN', '127.0.0.1')
+
+# Upper bounds in seconds of the buckets of every latency histogram
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+logger = logging.getLogger(__name__)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value)) for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}  # Tuple of label values -> value
+
+    def set(self, value, **labels):
+        """ Sets the value, for counters this mirrors a total that is kept elsewhere, e.g. in a stats dict """
+        with self.lock:
+            self.values[tuple(labels[name] for name in self.labels)] = value
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.kind)]
+        with self.lock:
+            for values, value in sorted(self.values.items()):
+                lines.append('{}{} {}'.format(self.name, _format_labels(self.labels, values), _format_value(value)))
+        return lines
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts[0][index] += 1
+            counts[1] += value
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.kind)]
+        with self.lock:
+            for values, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(self.name, _format_labels(
+                        self.labels, values, [('le', _format_value(bound))]), cumulative))
+                labels = _format_labels(self.labels, values)
+                lines.append('{}_sum{} {}'.format(self.name, labels, _format_value(total)))
+                lines.append('{}_count{} {}'.format(self.name, labels, cumulative))
+        return lines
+
+
+class Registry:
+    """ Holds the metrics of the bot and renders them in the Prometheus text format
+
+    Values that are tracked elsewhere, e.g. the stats dicts of the writer thread or the entity cache,
+    are copied into their metrics by collectors, which run right before the metrics are rendered.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self._register(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def add_collector(self, collector):
+        """ Registers a function without arguments that updates metrics before they are rendered """
+        with self.lock:
+            self.collectors.append(collector)
+
+    def render(self):
+        with self.lock:
+            collectors = list(self.collectors)
+            metrics = list(self.metrics)
+        for collector in collectors:
+            try:
+                collector()
+            except Exception:
+                logger.exception('Collecting metrics failed')
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def _register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+
+registry = Registry()
+
+handler_seconds = registry.histogram('sas_handler_duration_seconds', 'Time from a handler being called until it '
+                                     'returned, including the wait for the lanes of its games', ['handler'])
+handler_errors = registry.counter('sas_handler_errors_total', 'Handlers that raised', ['handler', 'error'])
+db_call_seconds = registry.histogram('sas_db_call_duration_seconds', 'Duration of the calls of the functions in '
+                                     'bot_database_interface, writes include the wait for their commit', ['function'])
+db_call_errors = registry.counter('sas_db_call_errors_total', 'Calls of bot_database_interface functions that raised',
+                                  ['function', 'error'])
+bot_api_seconds = registry.histogram('sas_bot_api_request_duration_seconds', 'Duration of the requests to the Bot '
+                                     'API, e.g. sendMessage', ['method'])
+bot_api_errors = registry.counter('sas_bot_api_errors_total', 'Requests to the Bot API that failed, e.g. with '
+                                  'Unauthorized once a player blocked the bot', ['method', 'error'])
+
+
+class InstrumentedRequest(Request):
+    """ Request of the bot that records the latency and the errors of every Bot API call, and a span if traced """
+
+    def post(self, url, data, timeout=None):
+        return self._measured(url.rsplit('/', 1)[-1], super().post, url, data, timeout)
+
+    def retrieve(self, url, timeout=None):
+        return self._measured('file', super().retrieve, url, timeout)
+
+    @staticmethod
+    def _measured(method, func, *args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        except TelegramError as e:
+            bot_api_errors.inc(method=method, error=type(e).__name__)
+            raise
+        finally:
+            end = time.perf_counter()
+            bot_api_seconds.observe(end - start, method=method)
+            record_span('bot_api', method, start, end)
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        data = self.server.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer:
+    """ Serves the metrics of a registry at /metrics
+
+    Requests are answered one after another on a single thread, scrapes are rare and the collectors
+    then always run on the same thread and database connection.
+    """
+
+    def __init__(self, registry, listen='127.0.0.1', port=9464):
+        self.httpd = HTTPServer((listen, port), _MetricsRequestHandler)
+        self.httpd.registry = registry
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='metrics', daemon=True)
+        self.thread.start()
+        logger.info('Serving metrics on port {}'.format(self.port))
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
@@ -0,0 +1,111 @@
+import hashlib
+import hmac
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+from src.bot_database_interface import game_exists
+
+# Every incoming update is appended to this file if it is set, replay it with bench/replay.py
+RECORD_FILE = os.getenv('SAS_RECORD_FILE')
+# Key of the pseudonyms, without it they change whenever the bot restarts
+RECORD_SALT = os.getenv('SAS_RECORD_SALT')
+
+RECORDING_VERSION = 2
+
+# Commands whose arguments are user ids, they are recorded as pseudonyms so the commands still work in a replay
+_ID_COMMANDS = ('/burn',)
+
+_PERSONAL_NAMES = ('first_name', 'last_name', 'username', 'title')
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateRecorder:
+    """ Appends every update to a JSON lines file with the players pseudonymised
+
+    User and chat ids are replaced by keyed hashes, so the same player keeps the same id throughout
+    the recording, names by names derived from those ids, and texts by placeholders of the same
+    length. Commands and game codes are kept, they are what the bot reacts to, and the player ids
+    passed to /burn are replaced by their pseudonyms. A digits-only text
+    naming an existing game also records the pseudonym of its master, so a replay can send it the
+    code of the game the master created in the replay instead.
+
+    The first line written after the file is opened is a header, every other line holds the time the
+    update arrived and the update itself.
+    """
+
+    def __init__(self, path, salt=None):
+        self.key = salt.encode() if salt else os.urandom(16)
+        self.lock = threading.Lock()
+        self.file = open(path, 'a', encoding='utf-8')
+        self._write({'recording': RECORDING_VERSION, 'started': round(time.time(), 3)})
+        self.recorded = 0
+
+    def record(self, update, context):
+        """ Callback for a TypeHandler in a group before every other handler """
+        line = {'t': round(time.time(), 3), 'u': self.pseudonymise(update.to_dict())}
+        text = update.message.text if update.message else None
+        if text and re.match(r'^\d+$', text):
+            game = game_exists(game_id=text)
+            if game:
+                line['g'] = self.pseudonym(game[1])
+        with self.lock:
+            self._write(line)
+            self.recorded += 1
+
+    def pseudonym(self, id):
+        """ Returns a stable stand-in for a user or chat id, negative ids of groups stay negative """
+        digest = hmac.new(self.key, str(abs(id)).encode(), hashlib.sha256).hexdigest()
+        pseudonym = 1 + int(digest[:12], 16)
+        return -pseudonym if id < 0 else pseudonym
+
+    def pseudonymise(self, data, key=None):
+        """ Returns a copy of an update dict without personal data """
+        if isinstance(data, list):
+            return [self.pseudonymise(item, key) for item in data]
+        if not isinstance(data, dict):
+            return data
+        result = {}
+        for name, value in data.items():
+            if name == 'id' and key in ('from', 'chat', 'user', 'sender_chat', 'forward_from'):
+                result[name] = self.pseudonym(value)
+            elif name in _PERSONAL_NAMES and isinstance(value, str):
+                result[name] = 'user{}'.format(self.pseudonym(data.get('id', 0)))
+            elif name in ('text', 'caption') and isinstance(value, str):
+                result[name] = placeholder(value, self.pseudonym)
+            elif name in ('file_id', 'file_unique_id'):
+                result[name] = hashlib.sha256(self.key + value.encode()).hexdigest()[:32]
+            elif name in ('contact', 'location', 'venue', 'phone_number') or value is None or value == []:
+                continue  # Defaults like the empty lists of to_dict() are left out to keep the file small
+            else:
+                result[name] = self.pseudonymise(value, name)
+        return result
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+        logger.info('Recorded {} updates'.format(self.recorded))
+
+    def _write(self, line):
+        self.file.write(json.dumps(line, separators=(',', ':'), ensure_ascii=False) + '\n')
+        self.file.flush()
+
+
+def placeholder(text, pseudonym=None):
+    """ Replaces a text by one of the same length, keeping a leading command and texts of only digits
+
+    :param pseudonym: function mapping a user id to its pseudonym, used for the arguments of the commands in
+                      _ID_COMMANDS, which are kept at their pseudonyms instead of being replaced
+    """
+    if re.match(r'^\d+$', text):
+        return text
+    command = re.match(r'^/\w+(@\w+)?', text)
+    kept = command.group(0) if command else ''
+    if pseudonym and command and kept.split('@')[0] in _ID_COMMANDS:
+        return kept + re.sub(r'\S+', lambda word: str(pseudonym(int(word.group(0)))) if word.group(0).isdigit()
+                             else 'x' * len(word.group(0)), text[len(kept):])
+    return kept + re.sub(r'\S', 'x', text[len(kept):])
@@ -0,0 +1,99 @@
+import functools
+import time
+
+from src.bot_database_interface import get_session
+from src.lanes import GameLanes
+from src.metrics import handler_seconds, handler_errors
+from src.tracing import traced, update_trace, record_span
+
+game_lanes = GameLanes()  # Serializes the commands that change the state of a game
+
+
+def resolve_session(update, context):
+    """ Returns the session of the user an update comes from, see get_session
+
+    The session is looked up once per update and kept in context.session, so handlers calling each other or
+    running in several handler groups share it.
+    """
+    session = getattr(context, 'session', None)
+    if session is None:
+        session = context.session = get_session(update.effective_chat.id)
+    return session
+
+
+def session_games(session):
+    """ Returns the ids of the games the user of a session is the master of or plays in """
+    game_ids = set()
+    if session['game_id'] is not None:
+        game_ids.add(session['game_id'])
+    if session['assassin'] is not None:
+        game_ids.add(session['assassin']['game'])
+    return game_ids
+
+
+def run_in_lanes(update, context, game_ids, command):
+    """ Runs a command in the lanes of the given games, see GameLanes.submit
+
+    If another command of the games is still running, the command is queued and later run through the
+    run_async of the dispatcher, which hands its errors to the error handlers like those of any callback.
+
+    :param command: function without arguments that changes the state of the games
+    :return: what command returned if it ran right away, None if it was queued
+    """
+    trace_id = update_trace(context)
+
+    def schedule(queued):
+        context.dispatcher.run_async(_traced_call, trace_id, queued, update=update)
+    return game_lanes.submit(game_ids, command, schedule)
+
+
+def _traced_call(trace_id, func):
+    with traced(trace_id):
+        return func()
+
+
+def update_handler(func=None, session=True, serialized=False):
+    """ Decorator for the callbacks registered with the dispatcher, records their duration and errors in the metrics
+
+    The callback runs in the trace of its update, with a span for the handler and one for the wait for the lanes.
+
+    :param session: resolve the session of the user before the callback runs, off for steps of a conversation
+                    that only collect input
+    :param serialized: run the callback in the lanes of the user's games, for commands that change the state of
+                       a game. The session is resolved again once it is their turn, earlier commands may have
+                       changed it. A callback that has to wait is queued and the dispatcher gets None back, so
+                       steps of a conversation use run_in_lanes for the part that changes the game instead
+    """
+    if func is None:
+        return functools.partial(update_handler, session=session, serialized=serialized)
+
+    @functools.wraps(func)
+    def wrapper(update, context, *args, **kwargs):
+        start = time.perf_counter()
+        game_ids, waiting = (), None
+
+        def run():
+            with traced(update_trace(context)):
+                try:
+                    if serialized:
+                        record_span('lane', 'wait for game lanes', waiting, time.perf_counter(),
+                                    games=sorted(game_ids))
+                        context.session = None
+                    if session or serialized:
+                        resolve_session(update, context)
+                    return func(update, context, *args, **kwargs)
+                except Exception as e:
+                    handler_errors.inc(handler=func.__name__, error=type(e).__name__)
+                    raise
+                finally:
+                    end = time.perf_counter()
+                    handler_seconds.observe(end - start, handler=func.__name__)
+                    record_span('handler', func.__name__, start, end, update_id=update.update_id)
+
+        if serialized:
+            with traced(update_trace(context)):
+                game_ids = session_games(resolve_session(update, context))
+            waiting = time.perf_counter()
+            return run_in_lanes(update, context, game_ids, run)
+        return run()
+    return wrapper
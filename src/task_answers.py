@@ -0,0 +1,113 @@
+import functools
+import itertools
+import logging
+import multiprocessing
+import re
+import threading
+import time
+
+# Seconds a single answer may take to be checked against the solution of the game master
+ANSWER_TIME_BUDGET = 1.0
+
+# Seconds an answer may wait for a free worker before it is given up on, without counting against its solution
+ANSWER_QUEUE_TIMEOUT = 10.0
+
+# Number of slots the workers note the start of a check in, more than answers are ever checked at the same time
+_START_SLOTS = 1024
+
+_started = None  # Shared array of start times in the worker processes, set by _init_worker
+
+logger = logging.getLogger(__name__)
+
+
+def validate_solution(solution):
+    """ Returns why the solution regex of a game master can not be used, None if it is valid """
+    try:
+        re.compile(solution)
+    except re.error as e:
+        return str(e)
+    return None
+
+
+@functools.lru_cache(maxsize=64)
+def _compile(solution):
+    return re.compile(solution)
+
+
+def _init_worker(started):
+    global _started
+    _started = started
+
+
+def _search(slot, solution, answer):
+    """ Runs in the worker processes, where each solution is only compiled once """
+    _started[slot] = time.time()
+    return _compile(solution).search(answer) is not None
+
+
+class AnswerChecker:
+    """ Checks task answers in worker processes, so a catastrophically backtracking regex can be killed
+
+    The time budget of an answer starts once a worker picks it up, waiting for the pool to be spawned
+    or for a free worker does not count. An answer that exceeds the budget counts as wrong and its
+    worker is replaced, every other answer to the same solution is still checked. Answers that were
+    running on the replaced pool at the same time are checked again on the new one.
+    """
+
+    def __init__(self, processes=2):
+        self.processes = processes
+        self.pool = None
+        self.lock = threading.Lock()
+        self.started = None
+        self.slots = itertools.count()
+
+    def start(self):
+        """ Spawns the worker processes and waits until they are ready, so the first answers do not wait for them """
+        self._get_pool()
+
+    def matches(self, solution, answer):
+        """ :return: True or False if the answer matches the solution, also False if checking it took longer than
+                 the time budget, None if no worker got to it in time
+        """
+        queued_until = time.time() + ANSWER_QUEUE_TIMEOUT
+        while True:
+            pool, started = self._get_pool()
+            slot = next(self.slots) % _START_SLOTS
+            started[slot] = 0.0
+            result = pool.apply_async(_search, (slot, solution, answer))
+            while not result.ready():
+                if self.pool is not pool:  # Replaced because of another answer, this one never finishes on it
+                    break
+                start = started[slot]
+                now = time.time()
+                if start and now >= start + ANSWER_TIME_BUDGET:
+                    logger.warning('Checking an answer against {} took longer than {}s: {}'.format(
+                        solution, ANSWER_TIME_BUDGET, answer))
+                    with self.lock:
+                        if self.pool is pool:  # The worker is stuck in the regex, the only way out is replacing it
+                            pool.terminate()
+                            self.pool = None
+                    threading.Thread(target=self._get_pool, name='answer-pool', daemon=True).start()  # Replace it now
+                    return False
+                if not start and now >= queued_until:  # No worker got to it, the answer is not to blame
+                    return None
+                result.wait(min(start + ANSWER_TIME_BUDGET - now, 0.01) if start else 0.01)
+            else:
+                return result.get()
+
+    def shutdown(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool = None
+
+    def _get_pool(self):
+        with self.lock:
+            if self.pool is None:
+                # Forking a process full of handler threads is unsafe, so the workers are spawned fresh
+                context = multiprocessing.get_context('spawn')
+                self.started = context.Array('d', _START_SLOTS, lock=False)
+                self.pool = context.Pool(self.processes, initializer=_init_worker, initargs=(self.started,))
+                # Spawned workers import the main module first, wait for that outside of any time budget
+                self.pool.starmap(_search, [(slot, '', '') for slot in range(self.processes)], chunksize=1)
+            return self.pool, self.started
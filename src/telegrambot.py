@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import functools
 import html
 import json
 import logging
@@ -9,15 +10,26 @@ import re
 import traceback
 from pathlib import Path
 
-from telegram import (ParseMode, InlineKeyboardButton, InlineKeyboardMarkup)
+from telegram import (Bot, ParseMode, InlineKeyboardButton, InlineKeyboardMarkup, Update)
 from telegram.error import (Unauthorized)
 from telegram.ext import (Updater, CommandHandler, MessageHandler, Filters,
-                          ConversationHandler, CallbackQueryHandler)
-
+                          ConversationHandler, CallbackQueryHandler, TypeHandler)
+
+from src.broadcaster import Broadcaster
+from src.game_engine import get_ring, drop_ring, eliminate, eliminate_many
+from src.media import PhotoIngester, choose_photo_size
+from src.metrics import registry, InstrumentedRequest, MetricsServer, METRICS_LISTEN, METRICS_PORT
+from src.recorder import UpdateRecorder, RECORD_FILE, RECORD_SALT
+from src.session import update_handler, game_lanes, resolve_session, run_in_lanes
+from src.task_answers import AnswerChecker, validate_solution
+from src.tracing import start_tracing
+from src.webhook import run_webhook
 from src.bot_database_interface import get_developers, add_game, db_start_game, game_started, \
-    get_assassin, get_master, add_assassin, game_exists, kill_player, remove_player, get_target_of, get_assassin_ids, \
-    assign_targets, get_game_id, set_presumed_dead, get_hunter, last_man_standing, change_subscription, get_subscribers, \
-    get_active_task, set_task_inactive, get_three_joker_users, add_task, give_task_point, set_game_stopped
+    get_master, add_assassin, get_assassin, game_exists, get_target_details, get_assassin_ids, \
+    change_subscription, get_subscribers, \
+    set_task_inactive, get_three_joker_users, set_photo_file_id, add_task, give_task_point, set_game_stopped, \
+    close_connections, start_storage, migrate, get_leaderboard_rows, get_game_version, count_started_games, \
+    writer_stats, entity_cache_stats, connection_stats
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -25,11 +37,29 @@ GAMECODE, ASSASSINNAME, CODENAME, WEAPON, ADDRESS, MAJOR, PICTURE = range(7)  #
 
 MESSAGE, REGEX, ANSWER = 0, 1, 2  # Constant for the task conversation, since there is only one step
 
+# 'polling' asks Telegram for new updates, 'webhook' has Telegram push them to an embedded HTTP server (see webhook.py)
+UPDATE_MODE = os.getenv('SAS_UPDATE_MODE', 'polling')
+
+# Where the Bot API is reached, only changed to run the bot against a local stand-in (see bench/bot_api_stub.py)
+API_BASE_URL = os.getenv('SAS_API_BASE_URL')
+API_BASE_FILE_URL = os.getenv('SAS_API_BASE_FILE_URL')
+
+# Handlers spend most of their time waiting on the Bot API and the database, so there are more than the default 4
+DISPATCHER_WORKERS = 16
+
 # Enable logging
 logging.basicConfig(filename='bot.log', format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                     level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+broadcaster = Broadcaster()  # Sends everything that goes out to more than one player
+
+photo_ingester = PhotoIngester()  # Stores the photos of new assassins
+
+answer_checker = AnswerChecker()  # Checks task answers against the solution regex of the game master
+
+_leaderboard_cache = {}  # Game id -> (game version, formatted leaderboard)
+
 
 def error_handler(update, context):
     logger.error(msg="Exception while handling an update:", exc_info=context.error)
@@ -52,6 +82,7 @@ def error_handler(update, context):
     update.message.reply_text('An error occurred, please try again. If the issue persists, text @ossner')
 
 
+@update_handler(session=False)
 def start(update, context):
     """ Welcome message for new users, command has to be entered at the start of every new conversation """
     logger.info('User name: {x}, id: {y} started the chat.'.format(x=update.message.from_user.first_name,
@@ -62,6 +93,7 @@ def start(update, context):
         'more about me and what I can do, type /help')
 
 
+@update_handler(session=False)
 def cancel(update, context):
     """ Fallback command if the user cancels the conversation """
     logger.info('User name: {x}, id: {y} cancelled the conversation.'.format(x=update.message.from_user.first_name,
@@ -70,6 +102,7 @@ def cancel(update, context):
     return ConversationHandler.END
 
 
+@update_handler(session=False)
 def new_game(update, context):
     logger.info('User name: {x}, id: {y} created a new game.'.format(x=update.message.from_user.first_name,
                                                                      y=update.message.chat_id))
@@ -90,6 +123,7 @@ def new_game(update, context):
             'You don\'t have a telegram username, please create one on your profile so your assassins can text you')
 
 
+@update_handler(serialized=True)
 def start_game(update, context):
     """ Start the game of the person issuing the command
 
@@ -99,22 +133,23 @@ def start_game(update, context):
     """
     logger.info('User name: {x}, id: {y} tried to start their game.'.format(x=update.message.from_user.first_name,
                                                                             y=update.message.chat_id))
-    game_id = get_game_id(game_master_id=update.message.chat_id)
-    if game_id:
-        if not game_started(game_id):
+    session = context.session
+    if session['role'] == 'master':
+        game_id = session['game_id']
+        if not session['started']:
             logger.info('User name: {x}, id: {y} started their game.'.format(x=update.message.from_user.first_name,
                                                                              y=update.message.chat_id))
-            db_start_game(game_id)
+            dossiers = db_start_game(game_id)
             update.message.reply_text('Your game has been started and your assassins will be notified')
-            assign_targets(game_id)
-            for assassin in get_assassin_ids(game_id):
-                send_target(context, assassin)
+            broadcaster.broadcast(context.bot, build_dossiers(dossiers),
+                                  report_to=update.message.chat_id, description='The dossiers')
         else:
             update.message.reply_text('Your game has already started')
     else:
         update.message.reply_text('You don\'t have a game registered, use /newgame to create one')
 
 
+@update_handler(serialized=True)
 def stop_game(update, context):
     """ This command stops the game of the person issuing it
 
@@ -124,19 +159,22 @@ def stop_game(update, context):
     1. The most kills (alive)
     2. The most kills (dead if more kills than alive)
     """
-    if get_game_id(game_master_id=update.message.chat_id):
-        if game_started(get_game_id(game_master_id=update.message.chat_id)):
+    session = context.session
+    if session['role'] == 'master':
+        game_id = session['game_id']
+        if session['started']:
             logger.info('User name: {x}, id: {y} stopped their game.'.format(x=update.message.from_user.first_name,
                                                                              y=update.message.chat_id))
-            for id in get_assassin_ids(get_game_id(game_master_id=update.message.chat_id)):
-                try:
-                    context.bot.send_message(id, 'That\'s it! This round of Secret Assassins Society has come to a close. '
-                                                 'Take a look at the final leaderboard:')
-                    context.bot.send_message(id, get_leaderboard(get_game_id(game_master_id=update.message.chat_id)),
-                                         parse_mode=ParseMode.MARKDOWN_V2)
-                except Unauthorized:
-                    logger.warning('User {} could not be contacted'.format(id))
-            set_game_stopped(get_game_id(game_master_id=update.message.chat_id))
+            final_leaderboard = get_leaderboard(game_id)
+            jobs = []
+            for id in get_assassin_ids(game_id):
+                jobs.append((id, {'text': 'That\'s it! This round of Secret Assassins Society has come to a close. '
+                                          'Take a look at the final leaderboard:'}))
+                jobs.append((id, {'text': final_leaderboard, 'parse_mode': ParseMode.MARKDOWN_V2}))
+            broadcaster.broadcast(context.bot, jobs, report_to=update.message.chat_id,
+                                  description='The final leaderboard')
+            set_game_stopped(game_id)
+            drop_ring(game_id)
             update.message.reply_text('Game has been stopped!')
         else:
             update.message.reply_text('Your game has not started yet, use /startgame to start it')
@@ -144,6 +182,7 @@ def stop_game(update, context):
         update.message.reply_text('You do not have a game registered. Create one with /newgame')
 
 
+@update_handler
 def broadcast(update, context, only_alive=True):
     """ Send a message to all the users participating in the game
 
@@ -151,46 +190,44 @@ def broadcast(update, context, only_alive=True):
     registered in the game. If True (default) it will only send the message
     to the players alive
     """
-    if get_game_id(game_master_id=update.message.chat_id):
+    session = context.session
+    if session['role'] == 'master':
         try:
             photo_file = update.message.photo[-1].file_id
             photo_caption = update.message.caption.strip('/broadcastAll ').strip('/broadcastall ')
             logger.info('User name: {x}, id: {y} broadcast an image.'.format(x=update.message.from_user.first_name,
                                                                              y=update.message.chat_id))
-            players = get_assassin_ids(get_game_id(update.message.chat_id), only_alive=only_alive)
-            for player in players:
-                try:
-                    context.bot.send_photo(player, photo_file, caption=photo_caption)
-                except Unauthorized:
-                    logger.warning('User {} could not be contacted'.format(player))
-            update.message.reply_text('Your image has been forwarded to {} players'.format(len(players)))
+            players = get_assassin_ids(session['game_id'], only_alive=only_alive)
+            broadcaster.broadcast(context.bot, [(player, {'photo': photo_file, 'caption': photo_caption})
+                                                for player in players],
+                                  report_to=update.message.chat_id, description='Your image')
+            update.message.reply_text('Your image is being forwarded to {} players'.format(len(players)))
         except IndexError:
             if context.args:
                 message = ' '.join(context.args)
                 logger.info('User name: {x}, id: {y} broadcast {z}.'.format(x=update.message.from_user.first_name,
                                                                             y=update.message.chat_id,
                                                                             z=message))
-                players = get_assassin_ids(get_game_id(update.message.chat_id), only_alive=only_alive)
-                for player in players:
-                    try:
-                        context.bot.send_message(player, message)
-                    except Unauthorized:
-                        logger.warning('User {} could not be contacted'.format(player))
-                update.message.reply_text('Your message has been forwarded to {} players'.format(len(players)))
+                players = get_assassin_ids(session['game_id'], only_alive=only_alive)
+                broadcaster.broadcast(context.bot, [(player, {'text': message}) for player in players],
+                                      report_to=update.message.chat_id, description='Your message')
+                update.message.reply_text('Your message is being forwarded to {} players'.format(len(players)))
             else:
                 update.message.reply_text('You can\'t send an empty message')
     else:
         update.message.reply_text('You don\'t have a game registered')
 
 
+@update_handler(session=False)
 def broadcast_all(update, context):
     """ Let's a game master send a message to all the players (alive or dead) """
     broadcast(update, context, only_alive=False)
 
 
+@update_handler
 def join_game(update, context):
     """ Start the sign-up process for users to join an existing game """
-    if get_assassin(update.message.chat_id):
+    if context.session['assassin']:
         update.message.reply_text('You are already enrolled in a running game. You can use /dropout to cancel that')
         return ConversationHandler.END
     else:
@@ -205,12 +242,14 @@ def join_game(update, context):
         return GAMECODE
 
 
+@update_handler(session=False)
 def get_assassin_name(update, context):
     logger.info('User name: {x}, id: {y} started signing up for a game.'.format(x=update.message.from_user.first_name,
                                                                                 y=update.message.chat_id))
     if re.match(r"^\d+$", update.message.text):
         context.user_data['game_id'] = int(update.message.text)
-        if not game_started(game_id=update.message.text) and game_exists(game_id=update.message.text):
+        game = game_exists(game_id=update.message.text)
+        if game and not game[3]:  # Exists and has not started yet
             update.message.reply_text('Got it, now please provide me with your full name')
             return ASSASSINNAME
         else:
@@ -221,6 +260,7 @@ def get_assassin_name(update, context):
         return ConversationHandler.END
 
 
+@update_handler(session=False)
 def get_code_name(update, context):
     context.user_data['name'] = update.message.text
     if dirty(context.user_data['name']):
@@ -231,6 +271,7 @@ def get_code_name(update, context):
         return CODENAME
 
 
+@update_handler(session=False)
 def check_needs_weapon(update, context):
     context.user_data['code_name'] = update.message.text
     if dirty(context.user_data['code_name']):
@@ -250,6 +291,7 @@ def check_needs_weapon(update, context):
         return WEAPON
 
 
+@update_handler(session=False)
 def get_address(update, context):
     query = update.callback_query
     query.answer()
@@ -260,6 +302,7 @@ def get_address(update, context):
     return ADDRESS
 
 
+@update_handler(session=False)
 def get_major(update, context):
     context.user_data['address'] = update.message.text
     if dirty(context.user_data['address']):
@@ -269,6 +312,7 @@ def get_major(update, context):
         return MAJOR
 
 
+@update_handler(session=False)
 def get_image(update, context):
     context.user_data['major'] = update.message.text
     if dirty(context.user_data['major']):
@@ -279,33 +323,45 @@ def get_image(update, context):
         return PICTURE
 
 
+@update_handler(session=False)
 def signup_done(update, context):
     try:
-        photo_file = update.message.photo[-1].get_file()
+        photo_size = choose_photo_size(update.message.photo)
     except IndexError:
         update.message.reply_text('Could not process picture, please try again')
         return PICTURE
+    # A /startgame running at the same time would leave the player out, so they are added in the lane of the game
+    run_in_lanes(update, context, [context.user_data['game_id']],
+                 functools.partial(finish_signup, update, dict(context.user_data), photo_size))
+    return ConversationHandler.END
+
+
+def finish_signup(update, signup, photo_size):
+    """ Adds a player to their game unless it has started in the meantime, runs in the lane of the game
+
+    :param signup: the answers the player gave during the signup, copied from user_data
+    """
     chat_id = update.message.chat_id
-    if not game_started(game_id=context.user_data['game_id']):
-        if add_assassin(chat_id, context.user_data['name'], context.user_data['code_name'],
-                        context.user_data['address'], context.user_data['major'], context.user_data['weapon'],
-                        context.user_data['game_id']):
-            photo_file.download('images/{}/{}.jpg'.format(context.user_data['game_id'], str(chat_id)))
-            update.message.reply_text(get_rules())
-            update.message.reply_text(
-                'That\'s it. I will contact you again once the game has begun. Stay vigilant! If you have any further '
-                'questions, text your game master @{}'.format(
-                    get_master(context.user_data['game_id'])['master_user']))
-            logger.info(
-                'User name: {x}, id: {y} finished signing up for a game.'.format(x=update.message.from_user.first_name,
-                                                                                 y=update.message.chat_id))
-        else:
-            update.message.reply_text('An error occurred, please try the sign-up again')
-    else:
+    game_id = signup['game_id']
+    started = game_started(game_id=game_id)
+    if not started and add_assassin(chat_id, signup['name'], signup['code_name'], signup['address'],
+                                    signup['major'], signup['weapon'], game_id, photo_file_id=photo_size.file_id):
+        # Downloaded in the background, the dossiers are sent by file_id until the game starts anyway
+        photo_ingester.enqueue(photo_size, os.path.join('images', str(game_id), str(chat_id) + '.jpg'))
+        update.message.reply_text(get_rules())
+        update.message.reply_text(
+            'That\'s it. I will contact you again once the game has begun. Stay vigilant! If you have any further '
+            'questions, text your game master @{}'.format(get_master(game_id)['master_user']))
+        logger.info(
+            'User name: {x}, id: {y} finished signing up for a game.'.format(x=update.message.from_user.first_name,
+                                                                             y=update.message.chat_id))
+    elif started:
         update.message.reply_text('Could not finish signup as game has already started')
-    return ConversationHandler.END
+    else:
+        update.message.reply_text('An error occurred, please try the sign-up again')
 
 
+@update_handler(serialized=True)
 def dropout(update, context):
     """ User wants to drop out of a game, notify hunter and update database
 
@@ -313,110 +369,181 @@ def dropout(update, context):
     to their hunter and then notify the hunter about their new target.
     If the game has not started yet, simply remove the player from the database
     """
-    user = get_assassin(update.message.chat_id)
+    user = context.session['assassin']
     if user:
         logger.info('User name: {x}, id: {y} dropped out of a game.'.format(x=update.message.from_user.first_name,
                                                                             y=update.message.chat_id))
-        if game_started(get_game_id(participant_id=update.message.chat_id)):
-            kill_player(update.message.chat_id)  # The game has started, so kill the player without attributing points
-            hunter_id = get_hunter(user['target'])['id']
+        # Kills the player without attributing points, or just removes them if the game has not started yet
+        result = eliminate(user['game'], update.message.chat_id)
+        if result and result['game_over']:
+            end_game(context, user['game'], result['hunter'])
+        elif result:
+            hunter_id = result['hunter']['id']
             context.bot.send_message(hunter_id, "Your target dropped out of the game. This is your new target:")
-            send_target(context, hunter_id)
-        else:
-            remove_player(update.message.chat_id)  # The game has not yet started, the user can just be removed
+            send_dossier(context, hunter_id, result['target'])
         update.message.reply_text('You took the coward\'s way out')
     else:
         update.message.reply_text('You are not enrolled in a game')
 
 
+@update_handler(serialized=True)
 def burn(update, context):
-    """ Forcefully removes a player from the game
+    """ Forcefully removes players from the game
 
-    A game master can invoke this command to remove a player
-    that has violated the rules from the game.
-    This needs to kill off the player in the database and
-    if the game has started, notify their hunter about the
-    new target.
+    A game master can invoke this command with one or more player ids
+    to remove players that have violated the rules from the game.
+    This needs to kill off the players in the database and
+    if the game has started, notify their hunters about their
+    new targets.
     """
     #  Check if calling user has a game associated with them
-    if get_game_id(game_master_id=update.message.chat_id):
+    session = context.session
+    if session['role'] == 'master':
+        game_id = session['game_id']
         #  Check command args validity
-        if context.args and re.match(r"^\d+$", context.args[0]):
-            player_id = context.args[0]
-            assassin = get_assassin(player_id)
+        if context.args and all(re.match(r"^\d+$", arg) for arg in context.args):
+            player_ids = [int(arg) for arg in context.args]
             logger.info('User name: {x}, id: {y} burned {z}.'.format(x=update.message.from_user.first_name,
                                                                      y=update.message.chat_id,
-                                                                     z=player_id))
-            #  Check if player is actually enrolled in this persons game TODO remove and handle with db
-            if get_game_id(game_master_id=update.message.chat_id) == get_game_id(participant_id=player_id):
-                kill_player(player_id)
-                send_target(context, get_hunter(assassin['target'])['id'])
+                                                                     z=player_ids))
+            #  Players that are not enrolled in this persons game are skipped by the database
+            result = eliminate_many(game_id, player_ids)
+            if result['game_over']:
+                end_game(context, game_id)
             else:
-                update.message.reply_text('This assassins is not enrolled in your game')
+                for hunter_id, target in result['retargeted']:
+                    send_dossier(context, hunter_id, target)
+            not_enrolled = set(player_ids) - set(result['killed'])
+            if not_enrolled:
+                update.message.reply_text('These assassins are not enrolled in your game or already dead: {}'.format(
+                    ', '.join(str(player_id) for player_id in not_enrolled)))
         else:
             update.message.reply_text('Specified player id is invalid')
     else:
         update.message.reply_text('You do not have a game registered')
 
 
+@update_handler
 def dossier(update, context):
     """ User requested their target's dossier, send all the needed information """
-    player = get_assassin(update.message.chat_id)
+    player = context.session['assassin']
     if player and player['target'] is not None:
-        if game_started(get_game_id(participant_id=update.message.chat_id)):
+        ring = get_ring(player['game'])
+        if ring:
             logger.info('User name: {x}, id: {y} requested their dossier.'.format(x=update.message.from_user.first_name,
                                                                                   y=update.message.chat_id))
-            send_target(context, update.message.chat_id)
+            send_dossier(context, update.message.chat_id,
+                         get_target_details(ring.target_of(update.message.chat_id)))
         else:
             update.message.reply_text('Your game has not started yet. You will get your target once the game starts')
     else:
         update.message.reply_text('You are either dead, or not enrolled in a game')
 
 
-def send_target(context, chat_id):
-    """ Send the target of the assassin with the specified id to that person
+def send_dossier(context, chat_id, target):
+    """ Send the dossier of the given target to the assassin with the specified id
+
+    :param target: (target_id, name, code_name, address, major, game_id, photo_file_id) as returned by get_target_of
+    """
+    payload = dossier_payload(target)
+    on_sent = payload.pop('on_sent', None)
+    try:
+        if isinstance(payload['photo'], Path):  # Not uploaded yet, send the file from disk
+            with open(payload['photo'], 'rb') as photo:
+                message = context.bot.send_photo(chat_id, **dict(payload, photo=photo))
+        else:
+            message = context.bot.send_photo(chat_id, **payload)
+        if on_sent:
+            on_sent(message)
+    except Unauthorized:
+        logger.error("Sending message to {} caused an exception".format(chat_id))
+
+
+def build_dossiers(dossiers):
+    """ Compose the dossiers for many assassins at once, ready to be handed to the broadcaster
+
+    :param dossiers: rows as returned by get_dossiers
+    :return: a list of (assassin_id, payload) jobs
+    """
+    return [(assassin_id, dossier_payload(target)) for assassin_id, *target in dossiers]
+
+
+def dossier_payload(target):
+    """ Compose dossier message with target details and randomly generated skills
 
-    This includes gathering the details from the database and formatting the
-    information with a little window-dressing with random skills
+    The photo is sent by its Telegram file_id, it is only uploaded from disk if that is not known yet.
+    :param target: (target_id, name, code_name, address, major, game_id, photo_file_id) as returned by get_target_of
+    :return: the arguments for send_photo, as accepted by the broadcaster
     """
-    # Gather needed information about target from the database
-    target_id, name, code_name, address, major, game_id = get_target_of(chat_id)
+    target_id, name, code_name, address, major, game_id, photo_file_id = target
     random_skills = ['lockpicking', 'hand-to-hand combat', 'target acquisition',
                      'covert operations', 'intelligence gathering', 'marksmanship',
                      'knife-throwing', 'explosives', 'poison', 'seduction',
                      'disguises', 'exotic weaponry', 'vehicles', 'boobytraps']
-    # Compose dossier message with target details and randomly generated skills
-    try:
-        context.bot.send_photo(chat_id,
-                               photo=open(os.path.join('images', str(game_id), str(target_id)) + '.jpg', 'rb'),
-                               caption='Name: {}\n\nCode name: {}\n\nAddress: {}\n\nMajor: {}\n\nSkills: {}'.format(
-                                   name,
-                                   code_name,
-                                   address,
-                                   major,
-                                   (', '.join(random.sample(random_skills, 2)))
-                               ))
-    except Unauthorized:
-        logger.error("Sending message to {} caused an exception".format(chat_id))
+    payload = {
+        'photo': photo_file_id,
+        'caption': 'Name: {}\n\nCode name: {}\n\nAddress: {}\n\nMajor: {}\n\nSkills: {}'.format(
+            name,
+            code_name,
+            address,
+            major,
+            (', '.join(random.sample(random_skills, 2)))
+        )
+    }
+    if not photo_file_id:
+        payload['photo'] = Path('images', str(game_id), str(target_id) + '.jpg')
+        payload['on_sent'] = lambda message: set_photo_file_id(target_id, message.photo[-1].file_id)
+    return payload
 
 
 def get_leaderboard(game_id):
-    all_assassin_ids = get_assassin_ids(game_id)
-    all_assassin_dicts = []
-    for id in all_assassin_ids:
-        all_assassin_dicts.append(get_assassin(id))
-    new_dicts = sorted(all_assassin_dicts, key=lambda k: k['tally'], reverse=True)
-    new_dicts_c = new_dicts.copy()
-    for dict in new_dicts:
-        if dict['target'] is None:
-            new_dicts_c.remove(dict)
-            new_dicts_c.append(dict)
-    ret_str = "`alive | codename               | kills`\n`----------------------------------------`"
-    for dict in new_dicts_c:
-        ret_str += "\n`{:<7}| {:<23}| {}`".format("✅" if dict['target'] else "❌", dict['code_name'], dict['tally'])
+    """ Returns the formatted leaderboard of a game, only rebuilt after the game has changed """
+    cached = _leaderboard_cache.get(game_id)
+    if cached and cached[0] == get_game_version(game_id):
+        return cached[1]
+    ring = get_ring(game_id)
+    if ring:
+        # A kill bumps the version before it updates the ring, both are only consistent under its lock
+        with ring.lock:
+            version = get_game_version(game_id)
+            rows = ring.leaderboard_rows()
+    else:
+        version = get_game_version(game_id)  # Taken first, so a change during the rebuild invalidates the result
+        rows = get_leaderboard_rows(game_id)
+    ret_str = "`#   | alive | codename               | kills`\n`----------------------------------------------`"
+    for rank, alive, code_name, tally in rows:
+        ret_str += "\n`{:<4}| {:<6}| {:<23}| {}`".format(rank, "✅" if alive else "❌", code_name, tally)
+    _leaderboard_cache[game_id] = (version, ret_str)
     return ret_str
 
 
+def end_game(context, game_id, winner=None):
+    """ Sends every assassin of a game that is over the winner and the final leaderboard, then stops the game
+
+    :param winner: the last player standing, a dict with at least their 'code_name' and 'tally',
+                   looked up in the ring of the game if it is not given
+    """
+    if winner is None:  # Burned players leave no hunter that took the last kill
+        winner_id = get_ring(game_id).last_man_standing()
+        winner = get_assassin(winner_id) if winner_id is not None else None
+    if winner:
+        text = ('That\'s it! This round of the Secret Assassins Society has come to a close and {} has won by being '
+                'the last (wo)man standing with {} eliminations. Take a look at the final leaderboard:'
+                .format(winner['code_name'], winner['tally']))
+    else:  # Everyone left was burned at once
+        text = ('That\'s it! This round of the Secret Assassins Society has come to a close without a winner, nobody '
+                'is left standing. Take a look at the final leaderboard:')
+    final_leaderboard = get_leaderboard(game_id)
+    jobs = []
+    for id in get_assassin_ids(game_id):
+        jobs.append((id, {'text': text}))
+        jobs.append((id, {'text': final_leaderboard, 'parse_mode': ParseMode.MARKDOWN_V2}))
+    broadcaster.broadcast(context.bot, jobs)
+    set_game_stopped(game_id)
+    drop_ring(game_id)
+
+
+@update_handler
 def leaderboard(update, context):
     """ Send the leaderboard to the person issuing the command
 
@@ -428,9 +555,8 @@ def leaderboard(update, context):
     ❌ | Jane Doe      | MrsDoe | 1
     ❌ | Doc Brown     | TheDoc | 0
     """
-    # Assign a value to game_id if this assassin is either a participant or a master, else None
-    game_id = get_game_id(game_master_id=update.message.chat_id) if get_game_id(game_master_id=update.message.chat_id) \
-        else get_game_id(participant_id=update.message.chat_id)
+    # The game of this user if they are either a participant or a master, else None
+    game_id = context.session['game_id']
     if game_id:
         logger.info('User name: {x}, id: {y} requested the leaderboard.'.format(x=update.message.from_user.first_name,
                                                                                 y=update.message.chat_id))
@@ -440,14 +566,16 @@ def leaderboard(update, context):
         update.message.reply_text('You are neither enrolled in a game, nor do you have one registered to yourself')
 
 
+@update_handler
 def game_overview(update, context):
     """ TODO Send a complete and comprehensive list of the players enrolled in the game,
      giving the game master a good overview of players alive and the paths the game has
     taken so far (perhaps send a graphical overview) """
-    if get_game_id(game_master_id=update.message.chat_id):
+    if context.session['role'] == 'master':
         pass
 
 
+@update_handler(serialized=True)
 def confirm_kill(update, context):
     """ Player claims to have killed their target, send confirmation request to target, which can be contested
 
@@ -456,22 +584,24 @@ def confirm_kill(update, context):
     Enter /confirmdead if this is true, if not contact your game master"
     The /confirmdead command will lead the user to the confirm_dead function
     """
-    hunter = get_assassin(update.message.chat_id)
-    #  Check if this person is enrolled in a game and has a target assigned
-    if hunter and hunter['target']:
-        master_username = get_master(hunter['game'])['master_user']
+    hunter = context.session['assassin']
+    ring = get_ring(hunter['game']) if hunter and hunter['started'] else None
+    #  Check if this person is enrolled in a running game and has a target assigned
+    if ring and ring.is_alive(hunter['id']):
+        target_id = ring.target_of(hunter['id'])
+        master_username = hunter['master_user']
         #  Check if the hit was already reported
-        if get_assassin(hunter['target'])['presumed_dead'] == 0:
+        if not ring.is_presumed_dead(target_id):
             logger.info('User name: {x}, id: {y} claimed a kill.'.format(x=update.message.from_user.first_name,
                                                                          y=update.message.chat_id))
             update.message.reply_text(
                 'Alright, I will check with your target. If you don\'t hear back from me soon, text your game master '
                 '@{}'.format(master_username))
             #  Set the target's presumed dead to 1 so the target can confirm that they are dead
-            set_presumed_dead(hunter['target'])
-            context.bot.send_message(hunter['target'], 'Your hunter has claimed your assassination. If this is true, '
-                                                       'issue the command /confirmDead otherwise text your game '
-                                                       'master @{}'.format(master_username))
+            ring.set_presumed_dead(target_id)
+            context.bot.send_message(target_id, 'Your hunter has claimed your assassination. If this is true, '
+                                                'issue the command /confirmDead otherwise text your game '
+                                                'master @{}'.format(master_username))
         else:
             logger.warning('User name: {x}, id: {y} claimed a kill for the second time.'.format(
                 x=update.message.from_user.first_name,
@@ -482,39 +612,31 @@ def confirm_kill(update, context):
         update.message.reply_text('You are not enrolled in a game or don\'t have a target assigned to you')
 
 
+@update_handler(serialized=True)
 def confirm_dead(update, context):
     """ Player confirms they have been killed, check if they are actually presumed dead and if so
     kill them off by setting their target value to NULL and sending their previous target to their killer
     """
-    target = get_assassin(update.message.chat_id)
+    target = context.session['assassin']
     if target:
-        if target['presumed_dead'] == 1:
+        ring = get_ring(target['game']) if target['started'] else None
+        if ring and ring.is_presumed_dead(target['id']):
             logger.info('User name: {x}, id: {y} confirmed they are dead.'.format(x=update.message.from_user.first_name,
                                                                                   y=update.message.chat_id))
             update.message.reply_text('You were too weak for the society')
-            killer = get_hunter(target['id'])
-            kill_player(target['id'], killer_id=killer['id'])
-            for subscriber in get_subscribers(target['game']):
-                context.bot.send_message(subscriber,
-                                         "There has been an assassination! {} wiped out {} bringing their tally up to "
-                                         "{}".format(
-                                             killer['code_name'], target['code_name'], (killer['tally'] + 1)))
-            context.bot.send_message(get_master(target['game'])['master_id'],
-                                     "There has been an assassination! {} wiped out {} bringing their tally up to "
-                                     "{}".format(
-                                         killer['code_name'], target['code_name'], (killer['tally'] + 1)))
-            if last_man_standing(target['game']):
-                for id in get_assassin_ids(target['game']):
-                    context.bot.send_message(id, 'That\'s it! This round of the Secret Assassins Society has come to a '
-                                                 'close and {} has won by being the last (wo)man standing with {} eliminations. '
-                                                 'Take a look at the final leaderboard:'
-                                             .format(killer['code_name'], killer['tally']))
-                    context.bot.send_message(id, get_leaderboard(get_game_id(game_master_id=update.message.chat_id)),
-                                             parse_mode=ParseMode.MARKDOWN_V2)
-                    set_game_stopped(target['game'])
-                pass
+            result = ring.kill(target['id'], assassinated=True)
+            if result is None:  # Confirmed twice, the first confirmation already took care of everything
+                return
+            killer = result['hunter']
+            announcement = {'text': "There has been an assassination! {} wiped out {} bringing their tally up to "
+                                    "{}".format(killer['code_name'], target['code_name'], killer['tally'])}
+            broadcaster.broadcast(context.bot, [(subscriber, announcement)
+                                                for subscriber in get_subscribers(target['game'])])
+            context.bot.send_message(target['master_id'], announcement['text'])
+            if result['game_over']:
+                end_game(context, target['game'], killer)
             else:
-                send_target(context, killer['id'])
+                send_dossier(context, killer['id'], result['target'])
         else:
             update.message.reply_text('Nobody has claimed your kill (yet)')
             pass
@@ -522,8 +644,9 @@ def confirm_dead(update, context):
         update.message.reply_text('You are not enrolled in a game')
 
 
+@update_handler
 def subscribe(update, context):
-    user = get_assassin(update.message.chat_id)
+    user = context.session['assassin']
     logger.info('User name: {x}, id: {y} toggled their subscription.'.format(x=update.message.from_user.first_name,
                                                                              y=update.message.chat_id))
     if user:  # User exists
@@ -531,39 +654,27 @@ def subscribe(update, context):
             update.message.reply_text('You will be notified of all assassinations on your game')
         else:  # User is a subscriber and wants to unsubscribe
             update.message.reply_text('Alright, you will no longer receive updates on kills in your game')
-        change_subscription(update.message.chat_id)
+        change_subscription(update.message.chat_id, not user['subscribed'])
     else:
         update.message.reply_text('You are not enrolled in a game')
 
 
+@update_handler
 def task(update, context):
     # Check if user is game master or if user is assassin
-    if get_game_id(game_master_id=update.message.chat_id):
-        game_id = get_game_id(game_master_id=update.message.chat_id)
-        if get_active_task(game_id):
-            logger.info(
-                'User: {x}, id: {y} stopped their active task.'.format(x=update.message.from_user.first_name,
-                                                                       y=update.message.chat_id))
-            set_task_inactive(game_id)
-            users_to_burn = get_three_joker_users(game_id)
-            print('Users to burn: {}'.format(users_to_burn))
-            for t_id in users_to_burn:
-                hunter = get_hunter(t_id)
-                kill_player(t_id)
-                context.bot.send_message(hunter['id'], 'Your target has been burned after not completing a task. This '
-                                                       'is your new target:')
-                send_target(context, hunter['id'])
-            update.message.reply_text('Your current task has been stopped and jokers have been updated. {} users have '
-                                      'been burned'.format(len(users_to_burn)))
+    session = context.session
+    if session['role'] == 'master':
+        if session['active_task']:
+            # Only stopping a task changes the game, participants asking for the task do not wait in its lane
+            run_in_lanes(update, context, [session['game_id']], functools.partial(stop_task, update, context))
         else:
             logger.info(
                 'User: {x}, id: {y} creates a new task.'.format(x=update.message.from_user.first_name,
                                                                 y=update.message.chat_id))
             update.message.reply_text('Specify the task you want your assassins to complete:')
             return MESSAGE
-    elif get_game_id(participant_id=update.message.chat_id):
-        game_id = get_game_id(participant_id=update.message.chat_id)
-        if get_active_task(game_id):
+    elif session['role'] == 'participant':
+        if session['active_task']:
             logger.info(
                 'User: {x}, id: {y} tries to answer a task.'.format(x=update.message.from_user.first_name,
                                                                     y=update.message.chat_id))
@@ -576,29 +687,87 @@ def task(update, context):
     return ConversationHandler.END
 
 
+def stop_task(update, context):
+    """ Stops the active task of a game and burns the players out of jokers, runs in the lane of the game
+
+    The new targets are sent on another worker of the dispatcher, so the lane is not held while they go out.
+    """
+    context.session = None
+    session = resolve_session(update, context)  # An earlier command may have stopped the task already
+    if not session['active_task']:
+        update.message.reply_text('Your task has already been stopped')
+        return
+    game_id = session['game_id']
+    set_task_inactive(game_id)
+    users_to_burn = get_three_joker_users(game_id)
+    result = eliminate_many(game_id, users_to_burn)
+    logger.info(
+        'User: {x}, id: {y} stopped their active task.'.format(x=update.message.from_user.first_name,
+                                                               y=update.message.chat_id))
+    logger.info('Users to burn: {}'.format(users_to_burn))
+    if result['game_over']:
+        end_game(context, game_id)
+    context.dispatcher.run_async(send_task_burns, update, context, users_to_burn,
+                                 [] if result['game_over'] else result['retargeted'], update=update)
+
+
+def send_task_burns(update, context, users_to_burn, retargeted):
+    for hunter_id, target in retargeted:
+        context.bot.send_message(hunter_id, 'Your target has been burned after not completing a task. '
+                                            'This is your new target:')
+        send_dossier(context, hunter_id, target)
+    update.message.reply_text('Your current task has been stopped and jokers have been updated. {} users have '
+                              'been burned'.format(len(users_to_burn)))
+
+
+@update_handler(session=False)
 def task_message(update, context):
     context.user_data['task_message'] = update.message.text
     update.message.reply_text('Got it. Now please enter the solution Regex')
     return REGEX
 
 
+@update_handler
 def task_solution(update, context):
+    error = validate_solution(update.message.text)
+    if error:
+        update.message.reply_text('This is not a valid Regex ({}), please try again'.format(error))
+        return REGEX
     context.user_data['task_solution'] = update.message.text
-    add_task(get_game_id(update.message.chat_id), context.user_data['task_message'], context.user_data['task_solution'])
-    for assassin in get_assassin_ids(get_game_id(game_master_id=update.message.chat_id), only_alive=True):
-        context.bot.send_message(assassin, 'Your game master has created a task for all assassins:')
-        context.bot.send_message(assassin, context.user_data['task_message'])
-    update.message.reply_text('Your task has been forwarded to your assassins')
+    game_id = context.session['game_id']
+    run_in_lanes(update, context, [game_id], functools.partial(
+        create_task, update, context, game_id, context.user_data['task_message'], update.message.text))
+    return ConversationHandler.END
+
+
+def create_task(update, context, game_id, message, solution):
+    """ Sets the task of a game and sends it to the assassins alive, runs in the lane of the game """
+    add_task(game_id, message, solution, sync=True)  # The assassins are about to ask for it
+    jobs = []
+    for assassin in get_assassin_ids(game_id, only_alive=True):
+        jobs.append((assassin, {'text': 'Your game master has created a task for all assassins:'}))
+        jobs.append((assassin, {'text': message}))
+    broadcaster.broadcast(context.bot, jobs, report_to=update.message.chat_id, description='Your task')
+    update.message.reply_text('Your task is being forwarded to your assassins')
     logger.info(
         'User: {x}, id: {y} created a new task.'.format(x=update.message.from_user.first_name,
                                                         y=update.message.chat_id))
-    return ConversationHandler.END
 
 
+@update_handler
 def task_answer(update, context):
     submitted_answer = update.message.text
-    pattern = re.compile(get_active_task(get_game_id(participant_id=update.message.chat_id))['solution'])
-    if pattern.search(submitted_answer):
+    player = context.session['assassin']
+    active_task = player['active_task'] if player else None
+    if active_task is None:
+        update.message.reply_text('The task has already been stopped')
+        return ConversationHandler.END
+    correct = answer_checker.matches(active_task['solution'], submitted_answer)
+    if correct is None:
+        update.message.reply_text('Your answer could not be checked, please text your game master')
+        logger.warning('No worker was free to check an answer to task {}: {}'.format(active_task['id'],
+                                                                                      submitted_answer))
+    elif correct:
         give_task_point(update.message.chat_id)
         update.message.reply_text('You have answered the task correctly!')
         logger.info(
@@ -613,6 +782,7 @@ def task_answer(update, context):
     return ConversationHandler.END
 
 
+@update_handler(session=False)
 def pm(update, context):
     """ Admin command that lets developers send personal messages to people by specifying their telegram_id"""
     if update.message.chat_id in get_developers() or update.message.chat_id == 755660906:
@@ -624,6 +794,7 @@ def pm(update, context):
         update.message.reply_text('Forbidden')
 
 
+@update_handler(session=False)
 def rules(update, context):
     update.message.reply_text('These are the rules for your game:\n' + get_rules())
 
@@ -646,6 +817,7 @@ def get_rules():
     return rule_text
 
 
+@update_handler(session=False)
 def help_overview(update, context):
     logger.info('User name: {x}, id: {y} requested help.'.format(x=update.message.from_user.first_name,
                                                                  y=update.message.chat_id))
@@ -675,14 +847,24 @@ def dirty(string):
     return re.compile(r'[@!#$%^&*<>?|}{~;]').search(string)
 
 
+@update_handler(session=False)
 def free_for_all(update, context):
     pass
 
 
-def main():
-    updater = Updater(os.getenv("SAS_TOKEN"), use_context=True, request_kwargs={'read_timeout': 20, 'connect_timeout': 30})
+def build_updater(recorder=None):
+    """ Creates the updater and registers every handler with its dispatcher
+
+    :param recorder: UpdateRecorder that keeps every incoming update for replays, if any
+    """
+    request = InstrumentedRequest(con_pool_size=DISPATCHER_WORKERS + 4, read_timeout=20, connect_timeout=30)
+    bot = Bot(os.getenv("SAS_TOKEN"), base_url=API_BASE_URL, base_file_url=API_BASE_FILE_URL, request=request)
+    updater = Updater(bot=bot, workers=DISPATCHER_WORKERS, use_context=True)
     dp = updater.dispatcher
 
+    if recorder:
+        dp.add_handler(TypeHandler(Update, recorder.record), group=-1)
+
     dp.add_handler(CommandHandler('start', start, run_async=True))
 
     dp.add_handler(CommandHandler('newgame', new_game, run_async=True))
@@ -751,9 +933,85 @@ def main():
     dp.add_handler(CommandHandler('pm', pm, run_async=True))
 
     dp.add_error_handler(error_handler)
+    return updater
+
+
+def register_metrics(dispatcher):
+    """ Copies the queue depths and the statistics of the bot's components into the metrics on every scrape """
+    queue_depth = registry.gauge('sas_dispatcher_queue_depth', 'Updates waiting for the dispatcher')
+    active_games = registry.gauge('sas_active_games', 'Games that have been started and not stopped yet')
+    busy_lanes = registry.gauge('sas_lanes_busy', 'Games with a mutating command running or waiting')
+    queued_commands = registry.gauge('sas_lane_commands_queued', 'Mutating commands running or waiting in a lane')
+    deepest_lane = registry.gauge('sas_lane_depth_max', 'Most commands ever queued in the lane of one game')
+    lane_commands = registry.counter('sas_lane_commands_total', 'Mutating commands that ran in the lanes of games')
+    lane_waits = registry.counter('sas_lane_waits_total', 'Mutating commands that waited for another one of their game')
+    lane_wait_seconds = registry.counter('sas_lane_wait_seconds_total', 'Time mutating commands spent waiting')
+    writer_queue = registry.gauge('sas_writer_queue_depth', 'Write operations waiting for the writer thread')
+    writer_operations = registry.counter('sas_writer_operations_total', 'Write operations run by the writer thread')
+    writer_commits = registry.counter('sas_writer_commits_total', 'Transactions committed by the writer thread')
+    writer_seconds = registry.counter('sas_writer_commit_seconds_total', 'Time the writer thread spent on batches')
+    cache_entries = registry.gauge('sas_entity_cache_entries', 'Read results in the entity cache')
+    cache_events = registry.counter('sas_entity_cache_events_total', 'Hits, misses, invalidations and evictions of '
+                                    'the entity cache', ['event'])
+    connections = registry.counter('sas_db_connections_total', 'Database connections opened, reused and closed',
+                                   ['event'])
+    photos = registry.counter('sas_photos_total', 'Signup photos queued, stored and failed', ['event'])
+
+    def collect():
+        queue_depth.set(dispatcher.update_queue.qsize())
+        active_games.set(count_started_games())
+        depths = game_lanes.depths()
+        busy_lanes.set(len(depths))
+        queued_commands.set(sum(depths.values()))
+        deepest_lane.set(game_lanes.stats['max_depth'])
+        lane_commands.set(game_lanes.stats['commands'])
+        lane_waits.set(game_lanes.stats['waited'])
+        lane_wait_seconds.set(game_lanes.stats['total_wait_seconds'])
+        stats = writer_stats()
+        if stats is not None:
+            writer_queue.set(stats['queue_depth'])
+            writer_operations.set(stats['operations'])
+            writer_commits.set(stats['commits'])
+            writer_seconds.set(stats['total_commit_seconds'])
+        stats = entity_cache_stats()
+        cache_entries.set(stats['entries'])
+        for event in ('hits', 'misses', 'invalidations', 'evictions'):
+            cache_events.set(stats[event], event=event)
+        for event, count in dict(connection_stats).items():
+            connections.set(count, event=event)
+        for event in ('queued', 'stored', 'failed'):
+            photos.set(photo_ingester.stats[event], event=event)
+    registry.add_collector(collect)
 
-    updater.start_polling()
-    updater.idle()
+
+def main():
+    migrate()
+    start_storage()
+    answer_checker.start()
+    # Opened here, the answer workers import this module and would otherwise open the files as well
+    recorder = UpdateRecorder(RECORD_FILE, RECORD_SALT) if RECORD_FILE else None
+    tracer = start_tracing()
+    updater = build_updater(recorder)
+    metrics_server = None
+    if METRICS_PORT:
+        register_metrics(updater.dispatcher)
+        metrics_server = MetricsServer(registry, METRICS_LISTEN, int(METRICS_PORT))
+        metrics_server.start()
+    if UPDATE_MODE == 'webhook':
+        run_webhook(updater)
+    else:
+        updater.start_polling()
+        updater.idle()
+    broadcaster.shutdown()
+    photo_ingester.shutdown()
+    answer_checker.shutdown()
+    if recorder:
+        recorder.close()
+    if metrics_server:
+        metrics_server.stop()
+    if tracer:
+        tracer.close()
+    close_connections()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,115 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# Spans of the traced updates are appended to this file if it is set, it opens in chrome://tracing or Perfetto
+TRACE_FILE = os.getenv('SAS_TRACE_FILE')
+# Fraction of the updates that are traced
+TRACE_SAMPLE_RATE = float(os.getenv('SAS_TRACE_SAMPLE_RATE', '1'))
+
+# Added to time.perf_counter() to get the wall clock time the trace viewers expect
+_PERF_COUNTER_EPOCH = time.time() - time.perf_counter()
+
+_local = threading.local()  # The id of the trace the calling thread works on, if it is sampled
+
+logger = logging.getLogger(__name__)
+
+
+class Tracer:
+    """ Writes spans in the Trace Event Format, one event per line
+
+    The file is a JSON array whose closing bracket is left out, which the trace viewers accept, so
+    events can be appended as they happen and across restarts of the bot. Every span carries the id
+    of the trace of its update in its args, the viewers can search for it.
+    """
+
+    def __init__(self, path, sample_rate=1.0):
+        self.sample_rate = sample_rate
+        self.lock = threading.Lock()
+        self.file = open(path, 'a', encoding='utf-8')
+        if self.file.tell() == 0:
+            self.file.write('[\n')
+        self.pid = os.getpid()
+        self.named_threads = set()
+
+    def start_trace(self):
+        """ Returns the id of a new trace, None if it is not sampled """
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return None
+        return uuid.uuid4().hex[:16]
+
+    def span(self, trace_id, category, name, start, end, args):
+        thread = threading.current_thread()
+        event = {'name': name, 'cat': category, 'ph': 'X', 'pid': self.pid, 'tid': thread.ident,
+                 'ts': round((start + _PERF_COUNTER_EPOCH) * 1e6, 1), 'dur': round((end - start) * 1e6, 1),
+                 'args': dict(args, trace_id=trace_id)}
+        with self.lock:
+            if thread.ident not in self.named_threads:  # Lets the viewers show the names of the threads
+                self.named_threads.add(thread.ident)
+                self._write({'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': thread.ident,
+                             'args': {'name': thread.name}})
+            self._write(event)
+            if category == 'handler':  # The update is done, spans of other threads are written with the next one
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+    def _write(self, event):
+        self.file.write(json.dumps(event, separators=(',', ':')) + ',\n')
+
+
+tracer = None  # Set by start_tracing()
+
+
+def start_tracing():
+    """ Opens TRACE_FILE if it is set and returns the tracer, None if tracing is disabled
+
+    Called by the main process of the bot, the spawned answer workers also import the bot and must
+    not open the file as well.
+    """
+    global tracer
+    if TRACE_FILE and tracer is None:
+        tracer = Tracer(TRACE_FILE, TRACE_SAMPLE_RATE)
+    return tracer
+
+
+def current_trace():
+    """ Returns the id of the trace of the calling thread, None if there is none or it is not sampled """
+    return getattr(_local, 'trace_id', None)
+
+
+def update_trace(context):
+    """ Returns the trace id of an update, it is decided once per update whether it is sampled """
+    if tracer is None:
+        return None
+    if not hasattr(context, 'trace_id'):
+        context.trace_id = tracer.start_trace()
+    return context.trace_id
+
+
+@contextmanager
+def traced(trace_id):
+    """ Records the spans of the calling thread in the given trace for the duration of the with block """
+    previous = getattr(_local, 'trace_id', None)
+    _local.trace_id = trace_id
+    try:
+        yield
+    finally:
+        _local.trace_id = previous
+
+
+def record_span(category, name, start, end, **args):
+    """ Records a span of the calling thread from start to end, both taken from time.perf_counter()
+
+    Does nothing unless the thread works on a sampled trace, so it can be called on every hot path.
+    """
+    trace_id = getattr(_local, 'trace_id', None)
+    if trace_id is not None:
+        tracer.span(trace_id, category, name, start, end, args)
@@ -0,0 +1,144 @@
+import hmac
+import json
+import logging
+import os
+import signal
+import ssl
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram import Update
+
+# Where the embedded server listens for updates, the public URL is registered with Telegram on startup if it is set.
+# Without a certificate and key the server speaks plain HTTP behind a proxy that terminates TLS
+WEBHOOK_LISTEN = os.getenv('SAS_WEBHOOK_LISTEN', '127.0.0.1')
+WEBHOOK_PORT = int(os.getenv('SAS_WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('SAS_WEBHOOK_PATH', '/telegram')
+WEBHOOK_URL = os.getenv('SAS_WEBHOOK_URL')
+WEBHOOK_SECRET = os.getenv('SAS_WEBHOOK_SECRET')
+WEBHOOK_CERT = os.getenv('SAS_WEBHOOK_CERT')
+WEBHOOK_KEY = os.getenv('SAS_WEBHOOK_KEY')
+
+# Telegram sends updates of at most a few kilobytes, anything much larger is not from Telegram
+MAX_UPDATE_BYTES = 1024 * 1024
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+logger = logging.getLogger(__name__)
+
+
+class _UpdateRequestHandler(BaseHTTPRequestHandler):
+    """ Accepts the updates Telegram posts to the webhook and puts them on the update queue of the dispatcher """
+
+    server_version = 'SecretAssassinsSociety'
+
+    def do_POST(self):
+        webhook = self.server.webhook
+        if self.path.split('?')[0] != webhook.path:
+            self._reply(404)
+            return
+        if webhook.secret_token is not None and not hmac.compare_digest(
+                self.headers.get(SECRET_TOKEN_HEADER, ''), webhook.secret_token):
+            webhook.count('rejected')
+            self._reply(403)
+            return
+        length = int(self.headers.get('Content-Length') or 0)
+        if length <= 0 or length > MAX_UPDATE_BYTES:
+            webhook.count('rejected')
+            self._reply(400)
+            return
+        try:
+            update = Update.de_json(json.loads(self.rfile.read(length)), webhook.bot)
+        except (ValueError, KeyError, TypeError):
+            webhook.count('rejected')
+            self._reply(400)
+            return
+        webhook.update_queue.put(update)
+        webhook.count('received')
+        self._reply(200)
+
+    def _reply(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug('Webhook request from {}: {}'.format(self.address_string(), format % args))
+
+
+class _Server(ThreadingHTTPServer):
+    request_queue_size = 128  # Telegram opens up to 40 connections at once, a load balancer even more
+    daemon_threads = True
+
+
+class WebhookServer:
+    """ Embedded HTTP server that receives updates pushed by Telegram instead of polling for them
+
+    Every request is handled on its own thread and only parses the update, the handlers run on the
+    dispatcher as usual. Without a certificate the server speaks plain HTTP and TLS is expected to be
+    terminated by a reverse proxy or load balancer in front of it.
+    """
+
+    def __init__(self, bot, update_queue, listen='127.0.0.1', port=8443, path='/telegram', secret_token=None,
+                 cert=None, key=None):
+        """
+        :param secret_token: requests without this value in the X-Telegram-Bot-Api-Secret-Token header are rejected
+        :param cert: certificate file to serve HTTPS with, together with the private key file in key
+        """
+        self.bot = bot
+        self.update_queue = update_queue
+        self.path = path if path.startswith('/') else '/' + path
+        self.secret_token = secret_token
+        self.stats = {'received': 0, 'rejected': 0}
+        self.stats_lock = threading.Lock()
+        self.httpd = _Server((listen, port), _UpdateRequestHandler)
+        self.httpd.webhook = self
+        if cert:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(cert, key)
+            self.httpd.socket = context.wrap_socket(self.httpd.socket, server_side=True)
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    def count(self, name):
+        with self.stats_lock:
+            self.stats[name] += 1
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='webhook', daemon=True)
+        self.thread.start()
+        logger.info('Webhook listening on port {} at {}'.format(self.port, self.path))
+
+    def stop(self):
+        """ Stops accepting updates, updates that were already queued are still handled by the dispatcher """
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+
+def run_webhook(updater):
+    """ Runs the dispatcher of the updater on updates received by a WebhookServer until SIGINT or SIGTERM
+
+    The webhook is registered with Telegram if WEBHOOK_URL is set, otherwise updates can be posted to the
+    server directly, e.g. recorded ones while testing locally.
+    """
+    dispatcher = updater.dispatcher
+    server = WebhookServer(updater.bot, dispatcher.update_queue, listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT,
+                           path=WEBHOOK_PATH, secret_token=WEBHOOK_SECRET, cert=WEBHOOK_CERT, key=WEBHOOK_KEY)
+    dispatcher_thread = threading.Thread(target=dispatcher.start, name='dispatcher')
+    dispatcher_thread.start()
+    server.start()
+    if WEBHOOK_URL:
+        api_kwargs = {'secret_token': WEBHOOK_SECRET} if WEBHOOK_SECRET else None
+        updater.bot.set_webhook(url=WEBHOOK_URL, api_kwargs=api_kwargs)
+    stopped = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *args: stopped.set())
+    stopped.wait()
+    logger.info('Stopping the webhook')
+    server.stop()
+    dispatcher.stop()
+    dispatcher_thread.join()